@@ -0,0 +1,133 @@
+"""Check and time callback routing: CallbackRouter vs. the old regex CallbackQueryHandler chain.
+
+Every callback_data the bot emits is resolved through build_callback_router() and
+checked against the handler it must reach; the old chain is run on the same data
+to show which buttons it shadowed.
+
+Run from the repository root:  python benchmarks/callback_router.py
+"""
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import newone  # noqa: E402
+
+# callback_data -> handler that must receive it
+EXPECTED = {
+    "cont_diary": "handle_start_buttons",
+    "restart_diary": "handle_start_buttons",
+    "change_code_start": "handle_start_buttons",
+    "morning_BCR25": "reminder_button_handler",
+    "evening_BCR25-2": "reminder_button_handler",
+    "morning_TEST": "reminder_button_handler",
+    "contactadmin_BCR25": "reminder_button_handler",
+    "update_code": "code_mismatch_handler",
+    "done_entry": "done_button_handler",
+    "done_entry:morning": "done_button_handler",
+    "done_entry:evening": "done_button_handler",
+    "p2a_confirm_yes": "participant_to_admin_confirm_callback",
+    "p2a_confirm_no": "participant_to_admin_confirm_callback",
+    "adm_check_progress": "admin_menu_handler",
+    "adm_find_code": "admin_menu_handler",
+    "adm_reset_change": "admin_menu_handler",
+    "adm_forgot": "admin_menu_handler",
+    "adm_broadcast": "admin_menu_handler",
+    "adm_private": "admin_menu_handler",
+    "adm_testall": "admin_menu_handler",
+    "adm_next_reminders": "admin_menu_handler",
+    "adm_stats": "admin_menu_handler",
+    "adm_export": "admin_menu_handler",
+    "adm_broadcast_confirm_yes": "admin_broadcast_confirm_callback",
+    "adm_broadcast_confirm_no": "admin_broadcast_confirm_callback",
+    "adm_bcancel_0123456789ab": "admin_broadcast_cancel_callback",
+    "adm_private_confirm_yes": "admin_private_confirm_callback",
+    "adm_private_confirm_no": "admin_private_confirm_callback",
+    "adm_export:participants:csv": "admin_export_callback",
+    "adm_export:entries:parquet": "admin_export_callback",
+    "adm_prog:n:": "admin_progress_page_callback",
+    "adm_prog:p:2bq": "admin_progress_page_callback",
+    "adm_pg:find:n:a:": "admin_code_page_callback",
+    "adm_pg:private:p:s1x9kd3:2bq": "admin_code_page_callback",
+    "adm_pgsearch:resetchange": "admin_code_page_callback",
+    "adm_find_BCR25": "admin_code_inline_handler",
+    "adm_find_A_B": "admin_code_inline_handler",
+    "adm_resetchange_BCR25": "admin_code_inline_handler",
+    "adm_private_BCR25": "admin_code_inline_handler",
+    "adm_reset_BCR25": "admin_reset_change_callback",
+    "adm_change_BCR25": "admin_reset_change_callback",
+    "adm_unknown_thing": "admin_code_inline_handler",
+    # Compact payloads: version "1", opcode, participant id in base 36
+    "1m2bq": "reminder_button_handler",
+    "1e0": "reminder_button_handler",
+    "1c2bq": "reminder_button_handler",
+    "1f2bq": "admin_code_inline_handler",
+    "1r2bq": "admin_code_inline_handler",
+    "1p2bq": "admin_code_inline_handler",
+    "1x2bq": "admin_reset_change_callback",
+    "1y2bq": "admin_reset_change_callback",
+}
+
+# The CallbackQueryHandler registrations main() used before the router, in order.
+LEGACY_CHAIN = [
+    ("^(cont_diary|restart_diary|change_code_start)$", "handle_start_buttons"),
+    ("^(morning_|evening_|contactadmin_)", "reminder_button_handler"),
+    ("^(update_code|restart_diary)$", "code_mismatch_handler"),
+    ("^done_entry$", "done_button_handler"),
+    ("^(p2a_confirm_yes|p2a_confirm_no)$", "participant_to_admin_confirm_callback"),
+    ("^(adm_check_progress|adm_find_code|adm_reset_change|adm_forgot|adm_broadcast|adm_private|adm_testall"
+     "|adm_next_reminders|adm_stats|adm_export)$", "admin_menu_handler"),
+    ("^(adm_broadcast_confirm_yes|adm_broadcast_confirm_no)$", "admin_broadcast_confirm_callback"),
+    ("^adm_bcancel_[0-9a-f]+$", "admin_broadcast_cancel_callback"),
+    ("^(adm_private_confirm_yes|adm_private_confirm_no)$", "admin_private_confirm_callback"),
+    ("^adm_export:", "admin_export_callback"),
+    ("^adm_prog:", "admin_progress_page_callback"),
+    ("^(adm_pg:|adm_pgsearch:)", "admin_code_page_callback"),
+    ("^adm_", "admin_code_inline_handler"),
+    ("^(adm_reset_|adm_change_)", "admin_reset_change_callback"),
+]
+LEGACY_CHAIN = [(re.compile(pattern), name) for pattern, name in LEGACY_CHAIN]
+
+def legacy_resolve(data):
+    for pattern, name in LEGACY_CHAIN:
+        if pattern.match(data):
+            return name
+    return None
+
+def check(router):
+    failures = 0
+    for data, expected in EXPECTED.items():
+        route = router.resolve(data)
+        got = route[0].__name__ if route else None
+        if got != expected:
+            failures += 1
+            print(f"FAIL {data!r}: routed to {got}, expected {expected}")
+        legacy = legacy_resolve(data)
+        if legacy != expected and newone.decode_callback(data) is None:
+            print(f"note {data!r}: the old regex chain sent this to {legacy}")
+    if router.resolve("1m2bq")[2] != int("2bq", 36):
+        failures += 1
+        print("FAIL '1m2bq' should carry participant id 2bq (base 36)")
+    if router.resolve("nonsense") is not None:
+        failures += 1
+        print("FAIL 'nonsense' should not route anywhere")
+    return failures
+
+def main():
+    router = newone.build_callback_router()
+    failures = check(router)
+    print(f"{len(EXPECTED) - failures}/{len(EXPECTED)} callbacks routed correctly")
+
+    samples = list(EXPECTED)
+    number = 20_000
+    old = timeit.timeit(lambda: [legacy_resolve(d) for d in samples], number=number)
+    new = timeit.timeit(lambda: [router.resolve(d) for d in samples], number=number)
+    per = number * len(samples)
+    print(f"regex chain: {old / per * 1e9:7.0f} ns/dispatch")
+    print(f"router:      {new / per * 1e9:7.0f} ns/dispatch ({old / new:.1f}x faster)")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Compare memory used by 100k participant dicts vs. Participant records.
+
+Run from the repository root:  python benchmarks/participant_memory.py
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from newone import Participant  # noqa: E402
+
+ROWS = 100_000
+
+def fake_rows(n):
+    for i in range(n):
+        yield (str(1_000_000_000 + i), "Blue", "Cat", "Rugby", "25", f"BCR{i}", i % 11, (i * 7) % 11)
+
+def as_dicts(rows):
+    users = []
+    for row in rows:
+        chat_id, color, animal, sport, age, code, m_count, n_count = row
+        users.append({
+            "chat_id": chat_id,
+            "color": color,
+            "animal": animal,
+            "sport": sport,
+            "age": age,
+            "code": code,
+            "morning_count": m_count or 0,
+            "night_count": n_count or 0
+        })
+    return users
+
+def as_participants(rows):
+    return [Participant(*row) for row in rows]
+
+def measure(build):
+    rows = list(fake_rows(ROWS))  # the row tuples themselves are shared, not measured
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    users = build(rows)
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del users
+    return after - before, peak - before
+
+def main():
+    dict_bytes, dict_peak = measure(as_dicts)
+    rec_bytes, rec_peak = measure(as_participants)
+    print(f"{ROWS} rows")
+    print(f"dict:        {dict_bytes / 1e6:8.2f} MB retained, {dict_peak / 1e6:8.2f} MB peak, "
+          f"{dict_bytes / ROWS:6.0f} B/row")
+    print(f"Participant: {rec_bytes / 1e6:8.2f} MB retained, {rec_peak / 1e6:8.2f} MB peak, "
+          f"{rec_bytes / ROWS:6.0f} B/row")
+    print(f"saving:      {(1 - rec_bytes / dict_bytes) * 100:.1f}%")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Time PostgresPersistence flushes: one batched write per round vs. one write per update.
+
+Each round marks ROUND_SIZES users dirty (as PTB does every PERSISTENCE_FLUSH_SECONDS)
+and times flush_pending(); the same rows are then written one transaction each, which
+is what persisting on every update would cost. Uses the database in $Postgres and
+leaves only its own rows (user ids from BENCH_USER_BASE up) behind, removed at the end.
+
+Run from the repository root:  Postgres=postgresql://... python benchmarks/persistence_flush.py
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import newone  # noqa: E402
+
+ROUND_SIZES = (10, 100, 1000, 5000)
+REPEATS = 5
+PER_UPDATE_LIMIT = 1000  # per-update writes are slow; time at most this many and scale
+BENCH_USER_BASE = 9_000_000_000_000
+
+def user_data(i):
+    return {"entry_type": "morning" if i % 2 else "evening",
+            "p2a_user_code": f"BCR{i}", "p2a_msg_text": "", "adm_broadcast_text": ""}
+
+async def batched_round(persistence, size):
+    await asyncio.gather(*(persistence.update_user_data(BENCH_USER_BASE + i, user_data(i))
+                           for i in range(size)))
+    started = time.perf_counter()
+    await persistence.flush()
+    return time.perf_counter() - started
+
+def per_update_round(size):
+    n = min(size, PER_UPDATE_LIMIT)
+    started = time.perf_counter()
+    for i in range(n):
+        newone.write_persistence_batch({BENCH_USER_BASE + i: user_data(i)}, (), {}, ())
+    return (time.perf_counter() - started) * size / n
+
+def cleanup():
+    with newone.get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM bot_user_data WHERE user_id >= %s", (BENCH_USER_BASE,))
+        conn.commit()
+
+async def main():
+    newone.init_db()
+    persistence = newone.PostgresPersistence()
+    print(f"{'dirty users':>12} {'batched flush':>14} {'per update':>12} {'speed-up':>9}")
+    try:
+        for size in ROUND_SIZES:
+            batched = statistics.median([await batched_round(persistence, size) for _ in range(REPEATS)])
+            single = per_update_round(size)
+            print(f"{size:>12} {batched * 1000:>11.1f} ms {single * 1000:>9.1f} ms {single / batched:>8.1f}x")
+    finally:
+        cleanup()
+        newone._db_executor.shutdown(wait=True)
+
+if __name__ == "__main__":
+    asyncio.run(main())
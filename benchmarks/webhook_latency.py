@@ -0,0 +1,218 @@
+"""Measure end-to-end update latency in webhook mode vs. polling, against a local stand-in for Telegram.
+
+The stand-in plays both sides of Telegram: a Bot API server (getMe, getUpdates with
+long polling, sendMessage, ...) and a client that emits updates, either by POSTing
+them to the bot's webhook (with the secret token, as Telegram does) or by queueing
+them for getUpdates. Both modes run the bot itself: newone.application_builder()
+(ChatOrderedApplication, concurrent updates, PostgresPersistence) and
+newone.add_handlers(). The updates alternate between /start from a registered
+participant (registration conversation) and free text (text_handler). Latency is the
+time from emitting an update until the bot's reply reaches the stand-in's sendMessage.
+The webhook is configured through newone.webhook_settings(), i.e. the same WEBHOOK_*
+settings main() uses, and the stand-in checks that setWebhook is only ever called
+with the configured URL.
+
+No network access or token is needed. The database is replaced by in-memory
+stand-ins for the participant lookup and the persistence reads/writes.
+
+Run from the repository root:  python benchmarks/webhook_latency.py
+"""
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+API_PORT = 18081
+WEBHOOK_PORT = 18443
+UPDATES = 300
+SECRET = "bench_secret_token"
+
+os.environ.update(WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_PORT=str(WEBHOOK_PORT),
+                  WEBHOOK_PATH="telegram", WEBHOOK_URL=f"http://127.0.0.1:{WEBHOOK_PORT}",
+                  WEBHOOK_SECRET=SECRET)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+import tornado.web  # noqa: E402
+
+import newone  # noqa: E402
+
+BOT_ID = 1
+
+class FakeTelegram:
+    """Bot API stand-in: queues updates for getUpdates and timestamps replies."""
+
+    def __init__(self):
+        self.updates = asyncio.Queue()
+        self.sent_at = {}     # update_id -> arrival time of the bot's reply
+        self.replied = {}     # update_id -> asyncio.Event
+        self.awaiting = {}    # chat id -> update_id whose reply is expected next
+        self.next_update_id = 1
+        self.webhooks_set = []  # params of every setWebhook call
+
+    def make_update(self):
+        update_id = self.next_update_id
+        self.next_update_id += 1
+        chat = {"id": 1000 + update_id % 50, "type": "private"}
+        self.replied[update_id] = asyncio.Event()
+        self.awaiting[chat["id"]] = update_id
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {"id": chat["id"], "is_bot": False, "first_name": "Bench"},
+            "text": "hello",
+        }
+        if update_id % 2:
+            message.update(text="/start", entities=[{"type": "bot_command", "offset": 0, "length": 6}])
+        return update_id, {"update_id": update_id, "message": message}
+
+    async def api(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+                    "can_join_groups": False, "can_read_all_group_messages": False,
+                    "supports_inline_queries": False}
+        if method == "getUpdates":
+            timeout = float(params.get("timeout", 0))
+            batch = []
+            try:
+                batch.append(await asyncio.wait_for(self.updates.get(), timeout=timeout or 0.01))
+                while not self.updates.empty():
+                    batch.append(self.updates.get_nowait())
+            except asyncio.TimeoutError:
+                pass
+            return batch
+        if method == "sendMessage":
+            update_id = self.awaiting.pop(int(params["chat_id"]))
+            self.sent_at[update_id] = time.perf_counter()
+            self.replied[update_id].set()
+            return {"message_id": update_id, "date": int(time.time()),
+                    "chat": {"id": int(params["chat_id"]), "type": "private"}, "text": params["text"]}
+        if method == "setWebhook":
+            self.webhooks_set.append(params)
+        return True  # deleteWebhook, setWebhook, ...
+
+    def app(self):
+        fake = self
+
+        class Handler(tornado.web.RequestHandler):
+            async def post(self, token, method):
+                params = {k: v[-1].decode() for k, v in self.request.body_arguments.items()}
+                if self.request.headers.get("Content-Type", "").startswith("application/json") and self.request.body:
+                    params = json.loads(self.request.body)
+                try:
+                    result = await fake.api(method, params)
+                except asyncio.CancelledError:
+                    return  # a long poll still open when the benchmark shuts down
+                self.write({"ok": True, "result": result})
+
+        return tornado.web.Application([(r"/bot([^/]+)/(\w+)", Handler)])
+
+class FakeDatabase:
+    """In-memory stand-ins for the DB calls the measured updates make."""
+
+    def __init__(self):
+        self.persisted_rows = 0
+
+    def load_user(self, chat_id):
+        return newone.Participant(chat_id=chat_id, color="blue", animal="cat", sport="golf", age="30",
+                                  code=f"BENCH{chat_id}", id=int(chat_id))
+
+    def write_persistence_batch(self, user_rows, dropped_users, conversation_rows, ended):
+        self.persisted_rows += len(user_rows) + len(dropped_users) + len(conversation_rows) + len(ended)
+
+    def install(self):
+        newone.load_user = self.load_user
+        newone.load_persisted_user_data = lambda user_id: None
+        newone.load_persisted_conversations = lambda name: {}
+        newone.write_persistence_batch = self.write_persistence_batch
+
+def build_application():
+    application = (newone.application_builder(newone.PostgresPersistence())
+                   .base_url(f"http://127.0.0.1:{API_PORT}/bot")
+                   .build())
+    newone.add_handlers(application)
+    return application
+
+async def measure(fake, emit):
+    latencies = []
+    for _ in range(UPDATES):
+        update_id, update = fake.make_update()
+        started = time.perf_counter()
+        await emit(update)
+        await asyncio.wait_for(fake.replied[update_id].wait(), timeout=10)
+        latencies.append(fake.sent_at[update_id] - started)
+    return latencies
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:<8} median {statistics.median(latencies) * 1000:6.2f} ms   "
+          f"p95 {p95 * 1000:6.2f} ms   max {latencies[-1] * 1000:6.2f} ms")
+
+def check_webhook_url_required(fake):
+    configured, newone.WEBHOOK_URL = newone.WEBHOOK_URL, ""
+    try:
+        newone.webhook_settings()
+        raise AssertionError("webhook mode started without WEBHOOK_URL")
+    except RuntimeError:
+        pass
+    finally:
+        newone.WEBHOOK_URL = configured
+    assert not fake.webhooks_set, f"setWebhook called without a configured URL: {fake.webhooks_set}"
+
+async def run_webhook_mode(fake):
+    check_webhook_url_required(fake)
+    settings = newone.webhook_settings()
+    url = f"http://127.0.0.1:{settings['port']}/{settings['url_path']}"
+    application = build_application()
+    await application.initialize()
+    await application.updater.start_webhook(**settings)
+    await application.start()
+    assert [(w["url"], w.get("secret_token")) for w in fake.webhooks_set] == \
+        [(settings["webhook_url"], SECRET)], f"unexpected setWebhook calls: {fake.webhooks_set}"
+    async with httpx.AsyncClient() as client:
+        headers = {"X-Telegram-Bot-Api-Secret-Token": settings["secret_token"]}
+        _, probe = fake.make_update()
+        rejected = await client.post(url, json=probe, headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+        assert rejected.status_code == 403, f"wrong secret accepted ({rejected.status_code})"
+
+        async def emit(update):
+            response = await client.post(url, json=update, headers=headers)
+            response.raise_for_status()
+
+        latencies = await measure(fake, emit)
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    return latencies
+
+async def run_polling_mode(fake):
+    application = build_application()
+    await application.initialize()
+    await application.updater.start_polling(poll_interval=0, timeout=10)
+    await application.start()
+    latencies = await measure(fake, fake.updates.put)
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    return latencies
+
+async def main():
+    fake = FakeTelegram()
+    database = FakeDatabase()
+    database.install()
+    newone.user_cache.maxsize = 0  # look every participant up, as on a cold cache
+    server = fake.app().listen(API_PORT, address="127.0.0.1")
+    try:
+        report("webhook", await run_webhook_mode(fake))
+        report("polling", await run_polling_mode(fake))
+        print(f"persistence rows written: {database.persisted_rows}")
+    finally:
+        server.stop()
+        newone._db_executor.shutdown(wait=True)
+
+if __name__ == "__main__":
+    asyncio.run(main())
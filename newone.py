@@ -1,25 +1,53 @@
+import asyncio
+import functools
+import hashlib
+import itertools
 import logging
 import os
+import re
+import socket
+import tempfile
+import threading
+import time
+import uuid
+import zlib
 import psycopg2
 import pytz
-from datetime import datetime
+from psycopg2 import errors as pg_errors
+from psycopg2 import sql
+from psycopg2.extras import Json, execute_values
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, time as dt_time
+from typing import NamedTuple, Optional
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    BasePersistence,
     CommandHandler,
     MessageHandler,
     ConversationHandler,
     CallbackQueryHandler,
     filters,
-    ContextTypes
+    ContextTypes,
+    PersistenceInput
 )
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet export is optional
+    pa = pq = None
+
 #############################
 # Basic Configuration
 #############################
@@ -32,212 +60,1412 @@ MODERATOR_ID = 1068291865
 ADMIN_ID = 1068291865  # Replace with your actual admin chat ID
 POSTGRES_URL = os.environ.get("Postgres")
 
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))         # seconds to wait for a free connection
+DB_POOL_MAX_LIFETIME = float(os.environ.get("DB_POOL_MAX_LIFETIME", "1800"))  # recycle connections older than this
+DB_POOL_MAX_IDLE = float(os.environ.get("DB_POOL_MAX_IDLE", "300"))      # close idle connections above DB_POOL_MIN
+DB_POOL_CHECK_AFTER = float(os.environ.get("DB_POOL_CHECK_AFTER", "30"))  # health-check connections idle longer than this
+# Updates processed at once (different chats only; one chat's updates still run in order)
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", str(DB_POOL_MAX * 4)))
+
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "5000"))  # participants kept in memory
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "300"))   # seconds before a cached row is re-read
+DEDUP_CACHE_SIZE = int(os.environ.get("DEDUP_CACHE_SIZE", "10000"))  # recent "I'm Done!" taps remembered in memory
+DEDUP_CACHE_TTL = float(os.environ.get("DEDUP_CACHE_TTL", "900"))
+DEDUP_RETENTION_DAYS = int(os.environ.get("DEDUP_RETENTION_DAYS", "3"))  # only today's keys can repeat; keep a margin
+CHAT_STATE_TTL = float(os.environ.get("CHAT_STATE_TTL", "900"))     # seconds a "type your ..." prompt stays open
+CHAT_STATE_MAX = int(os.environ.get("CHAT_STATE_MAX", "10000"))     # chats with an open prompt kept in memory
+
+USER_BATCH_SIZE = int(os.environ.get("USER_BATCH_SIZE", "500"))  # rows per server-side cursor fetch
+CODE_PAGE_SIZE = int(os.environ.get("CODE_PAGE_SIZE", "24"))      # codename buttons per admin picker page
+PROGRESS_PAGE_SIZE = int(os.environ.get("PROGRESS_PAGE_SIZE", "50"))  # participants per progress detail page
+PROGRESS_BEHIND_MARGIN = int(os.environ.get("PROGRESS_BEHIND_MARGIN", "2"))  # entries below the cohort average
+PROGRESS_BEHIND_LIST = 20
+MAX_MESSAGE_CHARS = 4000  # Telegram allows 4096; leave room for a header
+DIARY_PARTITIONS_AHEAD = int(os.environ.get("DIARY_PARTITIONS_AHEAD", "2"))  # future monthly partitions kept ready
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "5000"))  # rows per chunk written to an export file
+PERSISTENCE_FLUSH_SECONDS = float(os.environ.get("PERSISTENCE_FLUSH_SECONDS", "10"))  # user_data/conversation writes are batched this often
+PERSISTENCE_RETRY_MAX_SECONDS = float(os.environ.get("PERSISTENCE_RETRY_MAX_SECONDS", "60"))  # longest wait between failed flushes
+
+# Outgoing message fan-out. Telegram allows ~30 msg/s overall and ~1 msg/s per chat.
+FANOUT_CONCURRENCY = int(os.environ.get("FANOUT_CONCURRENCY", "20"))
+FANOUT_GLOBAL_RATE = float(os.environ.get("FANOUT_GLOBAL_RATE", "25"))
+FANOUT_PER_CHAT_INTERVAL = float(os.environ.get("FANOUT_PER_CHAT_INTERVAL", "1.0"))
+FANOUT_MAX_RETRIES = int(os.environ.get("FANOUT_MAX_RETRIES", "3"))
+
+# Durable outbox for participant-facing messages.
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "100"))      # rows claimed per dispatch round
+OUTBOX_POLL_SECONDS = float(os.environ.get("OUTBOX_POLL_SECONDS", "5"))  # idle poll when not woken
+OUTBOX_RECORD_EVERY = int(os.environ.get("OUTBOX_RECORD_EVERY", "20"))   # delivery results per status write
+OUTBOX_RETENTION_DAYS = int(os.environ.get("OUTBOX_RETENTION_DAYS", "30"))
+BROADCAST_PROGRESS_SECONDS = float(os.environ.get("BROADCAST_PROGRESS_SECONDS", "3"))  # how often the admin's progress message is edited
+OUTBOX_LEASE_SECONDS = int(os.environ.get("OUTBOX_LEASE_SECONDS", "120"))  # claimed rows return to the pool after this
+OUTBOX_PRIORITY_INTERACTIVE = 10  # participant<->admin messages are claimed before reminders and broadcasts
+OUTBOX_DELIVERY_TIMEOUT = float(os.environ.get("OUTBOX_DELIVERY_TIMEOUT", "300"))  # how long a sender's status is kept up to date
+
+# Multi-process deployment. BOT_ROLE=all runs polling, scheduler and dispatcher;
+# BOT_ROLE=worker runs only the dispatcher and the scheduler (if elected leader).
+BOT_ROLE = os.environ.get("BOT_ROLE", "all")
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+LEADER_LEASE_SECONDS = int(os.environ.get("LEADER_LEASE_SECONDS", "30"))
+LEADER_RENEW_SECONDS = int(os.environ.get("LEADER_RENEW_SECONDS", "10"))
+
+# How updates arrive. BOT_MODE=polling calls getUpdates; BOT_MODE=webhook runs an
+# embedded HTTP server (python-telegram-bot[webhooks]) that Telegram POSTs updates to.
+# WEBHOOK_URL (public HTTPS base URL, e.g. https://bot.example.com) is required: the
+# bot always registers the webhook itself on start, with WEBHOOK_SECRET as secret_token,
+# replacing whatever was registered before. Unset, the secret is derived from the bot
+# token, so every replica behind the same URL registers and accepts the same one.
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", os.environ.get("PORT", "8443")))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+
+# Enforce one participant per codename with a UNIQUE index on user_codes.code.
+# Set UNIQUE_CODES=0 to keep a plain (non-unique) index instead.
+UNIQUE_CODES = os.environ.get("UNIQUE_CODES", "1") != "0"
+MAX_CODE_ATTEMPTS = 20
+
 SINGAPORE_TZ = pytz.timezone("Asia/Singapore")
+DEFAULT_TIMEZONE = "Asia/Singapore"
 
 # Registration states
 REG_COLOR, REG_ANIMAL, REG_SPORT, REG_AGE = range(4)
 
 TARGET_COUNT = 10  # need 10 morning + 10 night
 
+REMINDER_TIMES = {"morning": (8, 0), "evening": (18, 0)}  # default (hour, minute), participant's local time
+FOLLOWUP_DELAY_MINUTES = int(os.environ.get("FOLLOWUP_DELAY_MINUTES", "60"))
+# Preferred reminder times are rounded to this step so participants share a bounded set of buckets.
+REMINDER_TIME_STEP_MINUTES = int(os.environ.get("REMINDER_TIME_STEP_MINUTES", "15"))
+BUCKET_REFRESH_MINUTES = int(os.environ.get("BUCKET_REFRESH_MINUTES", "10"))
+
 scheduler = AsyncIOScheduler()
 
 MORNING_FORM = "https://forms.gle/cUen9unFbdQDPtTT9"
 EVENING_FORM = "https://forms.gle/wya3mQY9bPurEDU79"
 CONCLUDING_FORM = "https://forms.gle/VZHUrsYSJnvyWjfq9"
 
-last_reminder_counts = {
-    "morning": {},
-    "evening": {}
-}
-
 #############################
 # Database Logic
 #############################
 
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    """Thread-safe pool of psycopg2 connections with health checks, recycling and metrics."""
+
+    def __init__(self, dsn, minconn, maxconn, timeout, max_lifetime, max_idle, check_after):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self._cond = threading.Condition()
+        self._idle = deque()   # (conn, created_at, last_used)
+        self._created = {}     # id(conn) -> created_at
+        self._checked_out = 0
+        self._waiting = 0
+        self._closed = False
+        self._metrics = {
+            "connects": 0,
+            "connect_errors": 0,
+            "connect_time_total": 0.0,
+            "connect_time_max": 0.0,
+            "checkouts": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "recycled": 0,
+            "health_check_failures": 0,
+            "discarded": 0,
+        }
+
+    def _connect(self):
+        start = time.perf_counter()
+        try:
+            conn = psycopg2.connect(self.dsn, sslmode='require')
+        except Exception:
+            with self._cond:
+                self._metrics["connect_errors"] += 1
+            raise
+        elapsed = time.perf_counter() - start
+        with self._cond:
+            self._metrics["connects"] += 1
+            self._metrics["connect_time_total"] += elapsed
+            self._metrics["connect_time_max"] = max(self._metrics["connect_time_max"], elapsed)
+            self._created[id(conn)] = time.monotonic()
+        logger.debug(f"Opened new DB connection in {elapsed * 1000:.1f} ms")
+        return conn
+
+    def _close_quietly(self, conn):
+        self._created.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception as e:
+            logger.warning(f"DB connection failed health check: {e}")
+            return False
+
+    def open(self):
+        """Pre-open DB_POOL_MIN connections."""
+        for _ in range(self.minconn):
+            conn = self._connect()
+            now = time.monotonic()
+            with self._cond:
+                self._idle.append((conn, self._created[id(conn)], now))
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        wait_start = time.perf_counter()
+        with self._cond:
+            self._waiting += 1
+            try:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout("Connection pool is closed.")
+                    if self._idle:
+                        conn, created_at, last_used = self._idle.pop()
+                        self._checked_out += 1
+                        break
+                    if self._checked_out + len(self._idle) < self.maxconn:
+                        conn, created_at, last_used = None, None, None
+                        self._checked_out += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._metrics["timeouts"] += 1
+                        raise PoolTimeout(f"No DB connection available after {self.timeout}s "
+                                          f"(max={self.maxconn}, checked_out={self._checked_out})")
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting -= 1
+            waited = time.perf_counter() - wait_start
+            self._metrics["checkouts"] += 1
+            self._metrics["wait_time_total"] += waited
+            self._metrics["wait_time_max"] = max(self._metrics["wait_time_max"], waited)
+
+        # Network I/O happens outside the lock.
+        try:
+            now = time.monotonic()
+            if conn is not None and now - created_at > self.max_lifetime:
+                self._close_quietly(conn)
+                with self._cond:
+                    self._metrics["recycled"] += 1
+                conn = None
+            if conn is not None and now - last_used > self.check_after and not self._is_healthy(conn):
+                self._close_quietly(conn)
+                with self._cond:
+                    self._metrics["health_check_failures"] += 1
+                conn = None
+            if conn is None:
+                conn = self._connect()
+            return conn
+        except Exception:
+            with self._cond:
+                self._checked_out -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn, discard=False):
+        now = time.monotonic()
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()  # never hand out a connection mid-transaction
+            except Exception:
+                discard = True
+        with self._cond:
+            self._checked_out -= 1
+            created_at = self._created.get(id(conn), now)
+            if discard or conn.closed or self._closed or now - created_at > self.max_lifetime:
+                if discard:
+                    self._metrics["discarded"] += 1
+                else:
+                    self._metrics["recycled"] += 1
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, created_at, now))
+                self._prune_idle(now)
+            self._cond.notify()
+
+    def _prune_idle(self, now):
+        # Oldest-used connections sit at the left; keep at least minconn around.
+        while len(self._idle) > self.minconn and now - self._idle[0][2] > self.max_idle:
+            conn, _, _ = self._idle.popleft()
+            self._close_quietly(conn)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _, _ = self._idle.popleft()
+                self._close_quietly(conn)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            m = dict(self._metrics)
+            m["checked_out"] = self._checked_out
+            m["idle"] = len(self._idle)
+            m["waiting"] = self._waiting
+            m["size"] = self._checked_out + len(self._idle)
+            m["min"] = self.minconn
+            m["max"] = self.maxconn
+        m["connect_time_avg"] = (m["connect_time_total"] / m["connects"]) if m["connects"] else 0.0
+        m["wait_time_avg"] = (m["wait_time_total"] / m["checkouts"]) if m["checkouts"] else 0.0
+        return m
+
+db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_pool():
+    global db_pool
+    if db_pool is None:
+        with _db_pool_lock:
+            if db_pool is None:
+                pool = ConnectionPool(
+                    POSTGRES_URL,
+                    minconn=DB_POOL_MIN,
+                    maxconn=DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    max_lifetime=DB_POOL_MAX_LIFETIME,
+                    max_idle=DB_POOL_MAX_IDLE,
+                    check_after=DB_POOL_CHECK_AFTER,
+                )
+                pool.open()
+                db_pool = pool
+                logger.info(f"DB pool ready (min={DB_POOL_MIN}, max={DB_POOL_MAX}).")
+    return db_pool
+
+@contextmanager
 def get_connection():
-    return psycopg2.connect(POSTGRES_URL, sslmode='require')
+    """Borrow a pooled connection. Broken connections are discarded instead of returned."""
+    pool = get_pool()
+    conn = pool.getconn()
+    discard = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        discard = True
+        raise
+    finally:
+        pool.putconn(conn, discard=discard)
+
+def get_pool_stats_text():
+    s = get_pool().stats()
+    return (
+        "DB pool:\n"
+        f"Size: {s['size']} (min {s['min']}, max {s['max']})\n"
+        f"Checked out: {s['checked_out']}, idle: {s['idle']}, waiting: {s['waiting']}\n"
+        f"Connects: {s['connects']} (errors {s['connect_errors']}), "
+        f"latency avg {s['connect_time_avg'] * 1000:.1f} ms / max {s['connect_time_max'] * 1000:.1f} ms\n"
+        f"Checkouts: {s['checkouts']}, wait avg {s['wait_time_avg'] * 1000:.1f} ms / "
+        f"max {s['wait_time_max'] * 1000:.1f} ms, timeouts {s['timeouts']}\n"
+        f"Recycled: {s['recycled']}, failed health checks: {s['health_check_failures']}, "
+        f"discarded: {s['discarded']}"
+    )
+
+
+#############################
+# Participant Record
+#############################
+
+class Participant(NamedTuple):
+    """One row of user_codes. Columns not selected by a query keep their defaults."""
+    chat_id: Optional[str] = None
+    color: Optional[str] = None
+    animal: Optional[str] = None
+    sport: Optional[str] = None
+    age: Optional[str] = None
+    code: Optional[str] = None
+    morning_count: int = 0
+    night_count: int = 0
+    timezone: Optional[str] = None
+    morning_time: Optional[dt_time] = None
+    evening_time: Optional[dt_time] = None
+    id: Optional[int] = None
+
+    @property
+    def remaining_morning(self):
+        return max(0, TARGET_COUNT - self.morning_count)
+
+    @property
+    def remaining_evening(self):
+        return max(0, TARGET_COUNT - self.night_count)
+
+    @property
+    def is_done(self):
+        return self.morning_count >= TARGET_COUNT and self.night_count >= TARGET_COUNT
+
+USER_COLUMNS = Participant._fields
+USER_SELECT = ", ".join(USER_COLUMNS)
+
+#############################
+# Compact Callback Data
+#############################
+
+# Per-participant buttons carry "<version><opcode><participant id in base 36>",
+# e.g. "1m2bq", instead of the codename, so payloads stay a few bytes whatever
+# the code looks like. Each opcode stands for the prefix the button used before,
+# so old buttons still in chats keep working alongside new ones.
+CALLBACK_VERSION = "1"
+CALLBACK_OPCODES = {
+    "m": "morning_",
+    "e": "evening_",
+    "c": "contactadmin_",
+    "f": "adm_find_",
+    "r": "adm_resetchange_",
+    "p": "adm_private_",
+    "x": "adm_reset_",
+    "y": "adm_change_",
+}
+CALLBACK_OPCODE_FOR = {prefix: op for op, prefix in CALLBACK_OPCODES.items()}
+_BASE36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def to_base36(n):
+    digits = []
+    while True:
+        n, r = divmod(n, 36)
+        digits.append(_BASE36[r])
+        if not n:
+            return "".join(reversed(digits))
+
+def encode_callback(prefix, participant_id):
+    return f"{CALLBACK_VERSION}{CALLBACK_OPCODE_FOR[prefix]}{to_base36(participant_id)}"
+
+def decode_callback(data):
+    """(prefix, participant id) for a compact payload, or None if `data` is not one."""
+    if len(data) < 3 or data[0] != CALLBACK_VERSION:
+        return None
+    prefix = CALLBACK_OPCODES.get(data[1])
+    if prefix is None:
+        return None
+    try:
+        return prefix, int(data[2:], 36)
+    except ValueError:
+        return None
+
+def participant_callback(prefix, participant_id, code):
+    """callback_data for a per-participant button; falls back to prefix+code when the id is unknown."""
+    if participant_id is None:
+        return f"{prefix}{code}"
+    return encode_callback(prefix, participant_id)
+
+def participant_from_row(row):
+    """Build a Participant from a row of USER_COLUMNS, treating NULL counts as 0."""
+    user = Participant._make(row)
+    if user.morning_count is None or user.night_count is None:
+        user = user._replace(morning_count=user.morning_count or 0, night_count=user.night_count or 0)
+    return user
+
+#############################
+# Participant Cache
+#############################
+
+class ParticipantCache:
+    """Bounded LRU/TTL cache of participant rows keyed by chat_id, with secondary code and id indexes."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # chat_id -> (user, expires_at)
+        self._by_code = {}             # code -> chat_id
+        self._by_id = {}               # participant id -> chat_id
+        self._version = 0              # bumped on every invalidation
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def version(self):
+        with self._lock:
+            return self._version
+
+    def _drop(self, chat_id):
+        entry = self._entries.pop(chat_id, None)
+        if entry:
+            self._unindex(entry[0])
+
+    def _unindex(self, user):
+        if self._by_code.get(user.code) == user.chat_id:
+            del self._by_code[user.code]
+        if self._by_id.get(user.id) == user.chat_id:
+            del self._by_id[user.id]
+
+    def _lookup(self, chat_id):
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            self._drop(chat_id)
+            return None
+        self._entries.move_to_end(chat_id)
+        return entry[0]
+
+    def get(self, chat_id):
+        with self._lock:
+            user = self._lookup(chat_id)
+            if user is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return user
+
+    def get_by_code(self, code):
+        with self._lock:
+            chat_id = self._by_code.get(code)
+            user = self._lookup(chat_id) if chat_id is not None else None
+            if user is None or user.code != code:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return user
+
+    def get_by_id(self, participant_id):
+        with self._lock:
+            chat_id = self._by_id.get(participant_id)
+            user = self._lookup(chat_id) if chat_id is not None else None
+            if user is None or user.id != participant_id:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return user
+
+    def put(self, user, version):
+        """Cache a row read at `version`; skipped if a write invalidated anything since."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if version != self._version:
+                return
+            chat_id = user.chat_id
+            self._drop(chat_id)
+            self._entries[chat_id] = (user, time.monotonic() + self.ttl)
+            self._by_code[user.code] = chat_id
+            if user.id is not None:
+                self._by_id[user.id] = chat_id
+            while len(self._entries) > self.maxsize:
+                _, (old_user, _) = self._entries.popitem(last=False)
+                self._unindex(old_user)
+                self.evictions += 1
+
+    def update_counts(self, chat_id, morning_count, night_count):
+        """Refresh the counters of a cached row in place after an atomic increment."""
+        with self._lock:
+            self._version += 1
+            entry = self._entries.get(chat_id)
+            if entry:
+                user = entry[0]._replace(morning_count=morning_count, night_count=night_count)
+                self._entries[chat_id] = (user, entry[1])
+
+    def invalidate(self, chat_id):
+        with self._lock:
+            self._version += 1
+            self.invalidations += 1
+            self._drop(chat_id)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+            self._by_code.clear()
+            self._by_id.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+            }
+
+user_cache = ParticipantCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+class EntryDedupCache:
+    """Recently recorded entries by dedup key, so repeated taps are answered without a DB round trip.
+
+    Only a fast path: the entry_dedup table is what guarantees an entry counts once.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # dedup_key -> (result, expires_at)
+        self.hits = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._entries[key]
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, result):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (result, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+entry_dedup_cache = EntryDedupCache(DEDUP_CACHE_SIZE, DEDUP_CACHE_TTL)
+
+class ChatStateStore:
+    """What the next free-text message from each chat is for: one (state, data) per chat.
+
+    Setting a state replaces the previous one, states expire after `ttl` and the
+    least recently set are dropped past `maxsize`, so an abandoned flow can neither
+    capture a later message nor hold memory.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._states = OrderedDict()  # chat_id -> (state, data, expires_at)
+        self.expired = 0
+
+    def set(self, chat_id, state, **data):
+        chat_id = str(chat_id)
+        self._states.pop(chat_id, None)
+        self._states[chat_id] = (state, data, time.monotonic() + self.ttl)
+        while len(self._states) > self.maxsize:
+            self._states.popitem(last=False)
+
+    def pop(self, chat_id):
+        """Remove and return (state, data) for `chat_id`, or (None, {}) if none is open."""
+        entry = self._states.pop(str(chat_id), None)
+        if entry is None:
+            return None, {}
+        state, data, expires_at = entry
+        if expires_at < time.monotonic():
+            self.expired += 1
+            return None, {}
+        return state, data
+
+    def clear(self, chat_id):
+        self._states.pop(str(chat_id), None)
+
+    def __len__(self):
+        return len(self._states)
+
+# Only touched on the event loop (handlers and get_bot_stats_text), so no lock.
+chat_states = ChatStateStore(CHAT_STATE_MAX, CHAT_STATE_TTL)
+
+def get_cache_stats_text():
+    c = user_cache.stats()
+    return (
+        "Participant cache:\n"
+        f"Entries: {c['size']}/{c['maxsize']}\n"
+        f"Hits: {c['hits']}, misses: {c['misses']} ({c['hit_rate'] * 100:.1f}% hit rate)\n"
+        f"Invalidations: {c['invalidations']}, evictions: {c['evictions']}\n"
+        f"Duplicate taps answered from memory: {entry_dedup_cache.hits} ({len(entry_dedup_cache)} remembered)\n"
+        f"Open text prompts: {len(chat_states)} (expired unanswered: {chat_states.expired})"
+    )
 
 def init_db():
     logger.info("Initializing the DB (create table if not exists).")
-    conn = get_connection()
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS user_codes (
+                    chat_id TEXT PRIMARY KEY,
+                    color   TEXT,
+                    animal  TEXT,
+                    sport   TEXT,
+                    age     TEXT,
+                    code    TEXT,
+                    morning_count INT DEFAULT 0 NOT NULL,
+                    night_count   INT DEFAULT 0 NOT NULL
+                );
+            """)
+            cur.execute(f"""
+                ALTER TABLE user_codes
+                    ADD COLUMN IF NOT EXISTS timezone     TEXT NOT NULL DEFAULT '{DEFAULT_TIMEZONE}',
+                    ADD COLUMN IF NOT EXISTS morning_time TIME NOT NULL DEFAULT '{REMINDER_TIMES["morning"][0]:02d}:{REMINDER_TIMES["morning"][1]:02d}',
+                    ADD COLUMN IF NOT EXISTS evening_time TIME NOT NULL DEFAULT '{REMINDER_TIMES["evening"][0]:02d}:{REMINDER_TIMES["evening"][1]:02d}';
+            """)
+            # Short stable participant id for compact callback_data (existing rows are numbered too)
+            cur.execute("ALTER TABLE user_codes ADD COLUMN IF NOT EXISTS id BIGINT GENERATED BY DEFAULT AS IDENTITY;")
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS user_codes_id_uidx ON user_codes (id);")
+            conn.commit()
+        ensure_code_index(conn)
+        ensure_reminder_indexes(conn)
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS reminder_snapshots (
+                    period   TEXT NOT NULL,
+                    chat_id  TEXT NOT NULL,
+                    count    INT NOT NULL,
+                    taken_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (period, chat_id)
+                );
+            """)
+            cur.execute("ALTER TABLE reminder_snapshots ADD COLUMN IF NOT EXISTS nudged_at TIMESTAMPTZ;")
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id          BIGSERIAL PRIMARY KEY,
+                    job_key     TEXT NOT NULL,
+                    chat_id     BIGINT NOT NULL,
+                    payload     JSONB NOT NULL,
+                    status      TEXT NOT NULL DEFAULT 'pending',
+                    attempts    INT NOT NULL DEFAULT 0,
+                    message_id  BIGINT,
+                    error       TEXT,
+                    created_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    sent_at     TIMESTAMPTZ,
+                    UNIQUE (job_key, chat_id)
+                );
+            """)
+            cur.execute("""
+                ALTER TABLE outbox
+                    ADD COLUMN IF NOT EXISTS claimed_by  TEXT,
+                    ADD COLUMN IF NOT EXISTS lease_until TIMESTAMPTZ,
+                    ADD COLUMN IF NOT EXISTS priority    SMALLINT NOT NULL DEFAULT 0;
+            """)
+            # Claim order is (priority DESC, id); this replaces the old id-only outbox_pending_idx.
+            cur.execute("DROP INDEX IF EXISTS outbox_pending_idx;")
+            cur.execute("CREATE INDEX IF NOT EXISTS outbox_pending_prio_idx ON outbox (priority DESC, id) WHERE status = 'pending';")
+            cur.execute("CREATE INDEX IF NOT EXISTS outbox_leased_idx ON outbox (lease_until) WHERE status = 'sending';")
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS leader_lease (
+                    name        TEXT PRIMARY KEY,
+                    holder      TEXT NOT NULL,
+                    lease_until TIMESTAMPTZ NOT NULL
+                );
+            """)
+            # Token bucket shared by every process sending as this bot (see SharedRateLimiter)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS send_rate (
+                    name         TEXT PRIMARY KEY,
+                    tokens       DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    updated_at   TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp(),
+                    paused_until TIMESTAMPTZ
+                );
+            """)
+            cur.execute("INSERT INTO send_rate (name) VALUES ('telegram') ON CONFLICT (name) DO NOTHING;")
+            # Append-only log of completed entries; the counters on user_codes are its running totals.
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS diary_entries (
+                    id          BIGINT GENERATED ALWAYS AS IDENTITY,
+                    chat_id     TEXT NOT NULL,
+                    entry_type  TEXT NOT NULL CHECK (entry_type IN ('morning', 'evening')),
+                    created_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    callback_id TEXT,
+                    PRIMARY KEY (id, created_at)
+                ) PARTITION BY RANGE (created_at);
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS diary_entries_chat_idx ON diary_entries (chat_id, created_at);")
+            cur.execute("CREATE INDEX IF NOT EXISTS diary_entries_type_idx ON diary_entries (entry_type, created_at);")
+            # Catches rows if a monthly partition is ever missing; normally stays empty.
+            cur.execute("CREATE TABLE IF NOT EXISTS diary_entries_default PARTITION OF diary_entries DEFAULT;")
+            # One row per recorded entry, keyed by participant, period and the participant's local
+            # day. A unique key cannot live on diary_entries itself because it would have to
+            # include created_at.
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS entry_dedup (
+                    dedup_key   TEXT PRIMARY KEY,
+                    chat_id     TEXT NOT NULL,
+                    created_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+                );
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS entry_dedup_created_idx ON entry_dedup (created_at);")
+            # PostgresPersistence: per-user context.user_data and ConversationHandler states
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS bot_user_data (
+                    user_id     BIGINT PRIMARY KEY,
+                    data        JSONB NOT NULL,
+                    updated_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+                );
+            """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS bot_conversations (
+                    name        TEXT NOT NULL,
+                    key         BIGINT[] NOT NULL,
+                    state       JSONB NOT NULL,
+                    updated_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (name, key)
+                );
+            """)
+            conn.commit()
+        ensure_diary_partitions(conn)
+
+def month_start(year, month):
+    year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+    return datetime(year, month, 1, tzinfo=pytz.utc)
+
+def ensure_diary_partitions(conn, ahead=DIARY_PARTITIONS_AHEAD):
+    """Create the monthly diary_entries partitions for this month and the next `ahead` months (UTC)."""
+    now = datetime.now(pytz.utc)
+    with conn.cursor() as cur:
+        for offset in range(ahead + 1):
+            start = month_start(now.year, now.month + offset)
+            end = month_start(start.year, start.month + 1)
+            name = f"diary_entries_{start:%Y_%m}"
+            try:
+                cur.execute(sql.SQL("""
+                    CREATE TABLE IF NOT EXISTS {} PARTITION OF diary_entries
+                    FOR VALUES FROM (%s) TO (%s)
+                """).format(sql.Identifier(name)), (start, end))
+                conn.commit()
+            except psycopg2.Error as e:
+                # e.g. rows for that month already landed in the default partition
+                conn.rollback()
+                logger.error(f"Could not create partition {name}: {e}")
+
+def maintain_diary_partitions():
+    with get_connection() as conn:
+        ensure_diary_partitions(conn)
+
+def ensure_code_index(conn):
+    """Create (or migrate to) the configured index on user_codes.code."""
+    unique = UNIQUE_CODES
     with conn.cursor() as cur:
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS user_codes (
-                chat_id TEXT PRIMARY KEY,
-                color   TEXT,
-                animal  TEXT,
-                sport   TEXT,
-                age     TEXT,
-                code    TEXT,
-                morning_count INT DEFAULT 0 NOT NULL,
-                night_count   INT DEFAULT 0 NOT NULL
-            );
-        """)
+        if unique:
+            cur.execute("""
+                SELECT code, COUNT(*)
+                FROM user_codes
+                WHERE code IS NOT NULL
+                GROUP BY code
+                HAVING COUNT(*) > 1
+            """)
+            dupes = cur.fetchall()
+            if dupes:
+                listing = ", ".join(f"{code} (x{n})" for code, n in dupes)
+                logger.error(f"Cannot create UNIQUE index on user_codes.code, duplicate codes exist: {listing}. "
+                             "Falling back to a non-unique index until they are resolved.")
+                unique = False
+        if unique:
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS user_codes_code_uidx ON user_codes (code);")
+            cur.execute("DROP INDEX IF EXISTS user_codes_code_idx;")
+        else:
+            cur.execute("CREATE INDEX IF NOT EXISTS user_codes_code_idx ON user_codes (code);")
+            cur.execute("DROP INDEX IF EXISTS user_codes_code_uidx;")
+        # Byte-order copy for the admin code picker: keyset pages on (code, id) and LIKE 'prefix%' both use it.
+        cur.execute('CREATE INDEX IF NOT EXISTS user_codes_code_c_id_idx ON user_codes ((code COLLATE "C"), id);')
+        cur.execute("DROP INDEX IF EXISTS user_codes_code_c_idx;")
         conn.commit()
-    conn.close()
+    logger.info(f"Index on user_codes.code is {'unique' if unique else 'non-unique'}.")
 
-def fix_db():
-    logger.info("Fixing DB for any NULL morning/night counts.")
-    conn = get_connection()
+def ensure_reminder_indexes(conn):
+    """Partial indexes backing reminder_target_filter() and the bucket lookup for each period."""
     with conn.cursor() as cur:
-        cur.execute("UPDATE user_codes SET morning_count=0 WHERE morning_count IS NULL;")
-        cur.execute("UPDATE user_codes SET night_count=0 WHERE night_count IS NULL;")
+        for period, column in REMINDER_COUNT_COLUMN.items():
+            time_column = REMINDER_TIME_COLUMN[period]
+            cur.execute(f"""
+                CREATE INDEX IF NOT EXISTS user_codes_{period}_bucket_idx
+                ON user_codes (timezone, {time_column}, {column}) INCLUDE (chat_id, code)
+                WHERE {REMINDER_BASE_SQL};
+            """)
+            cur.execute(f"DROP INDEX IF EXISTS user_codes_{period}_pending_idx;")
         conn.commit()
-    conn.close()
+
+def fix_db():
+    logger.info("Fixing DB for any NULL morning/night counts.")
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("UPDATE user_codes SET morning_count=0 WHERE morning_count IS NULL;")
+            cur.execute("UPDATE user_codes SET night_count=0 WHERE night_count IS NULL;")
+            conn.commit()
 
 def load_user(chat_id):
     """Load a single user row by chat_id."""
     logger.debug(f"Loading user by chat_id={chat_id}")
-    conn = get_connection()
-    with conn.cursor() as cur:
-        cur.execute("""
-            SELECT color, animal, sport, age, code, morning_count, night_count
-            FROM user_codes
-            WHERE chat_id=%s
-        """, (chat_id,))
-        row = cur.fetchone()
-    conn.close()
+    cached = user_cache.get(chat_id)
+    if cached:
+        return cached
+    version = user_cache.version()
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT {USER_SELECT}
+                FROM user_codes
+                WHERE chat_id=%s
+            """, (chat_id,))
+            row = cur.fetchone()
     if row:
-        color, animal, sport, age, code, m_count, n_count = row
-        return {
-            "chat_id": chat_id,
-            "color": color,
-            "animal": animal,
-            "sport": sport,
-            "age": age,
-            "code": code,
-            "morning_count": m_count or 0,
-            "night_count": n_count or 0
-        }
+        user = participant_from_row(row)
+        user_cache.put(user, version)
+        return user
     return None
 
 def load_user_by_code(codename):
     """Load a single user row by codename."""
     logger.debug(f"Loading user by code={codename}")
-    conn = get_connection()
-    with conn.cursor() as cur:
-        cur.execute("""
-            SELECT chat_id, color, animal, sport, age, code, morning_count, night_count
-            FROM user_codes
-            WHERE code=%s
-        """, (codename,))
-        row = cur.fetchone()
-    conn.close()
+    cached = user_cache.get_by_code(codename)
+    if cached:
+        return cached
+    version = user_cache.version()
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT {USER_SELECT}
+                FROM user_codes
+                WHERE code=%s
+                ORDER BY chat_id
+                LIMIT 2
+            """, (codename,))
+            rows = cur.fetchall()
+    if len(rows) > 1:
+        logger.warning(f"Multiple users share code={codename}, using chat_id={rows[0][0]}")
+    if rows:
+        user = participant_from_row(rows[0])
+        if len(rows) == 1:
+            user_cache.put(user, version)
+        return user
+    return None
+
+def load_user_by_id(participant_id):
+    """Load a single user row by its numeric id (as carried in compact callback_data)."""
+    cached = user_cache.get_by_id(participant_id)
+    if cached:
+        return cached
+    version = user_cache.version()
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT {USER_SELECT} FROM user_codes WHERE id=%s", (participant_id,))
+            row = cur.fetchone()
     if row:
-        chat_id, color, animal, sport, age, code, m_count, n_count = row
-        return {
-            "chat_id": chat_id,
-            "color": color,
-            "animal": animal,
-            "sport": sport,
-            "age": age,
-            "code": code,
-            "morning_count": m_count or 0,
-            "night_count": n_count or 0
-        }
+        user = participant_from_row(row)
+        user_cache.put(user, version)
+        return user
     return None
 
-def get_all_users():
-    logger.debug("Getting all users from DB.")
-    conn = get_connection()
-    with conn.cursor() as cur:
-        cur.execute("""
-            SELECT chat_id, color, animal, sport, age, code, morning_count, night_count
-            FROM user_codes
-        """)
-        rows = cur.fetchall()
-    conn.close()
-    users = []
-    for row in rows:
-        chat_id, color, animal, sport, age, code, m_count, n_count = row
-        users.append({
-            "chat_id": chat_id,
-            "color": color,
-            "animal": animal,
-            "sport": sport,
-            "age": age,
-            "code": code,
-            "morning_count": m_count or 0,
-            "night_count": n_count or 0
-        })
-    return users
-
-def save_user(chat_id, color, animal, sport, age, code, morning_count=0, night_count=0):
-    logger.debug(f"Saving user with chat_id={chat_id}, code={code}, morning_count={morning_count}, night_count={night_count}")
-    morning_count = morning_count or 0
-    night_count = night_count or 0
-    conn = get_connection()
-    with conn.cursor() as cur:
-        cur.execute("""
-            INSERT INTO user_codes (chat_id, color, animal, sport, age, code, morning_count, night_count)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (chat_id) DO UPDATE
-              SET color=EXCLUDED.color,
-                  animal=EXCLUDED.animal,
-                  sport=EXCLUDED.sport,
-                  age=EXCLUDED.age,
-                  code=EXCLUDED.code,
-                  morning_count=EXCLUDED.morning_count,
-                  night_count=EXCLUDED.night_count
-        """, (chat_id, color, animal, sport, age, code, morning_count, night_count))
-        conn.commit()
-    conn.close()
+_cursor_ids = itertools.count(1)  # unique names for server-side cursors
+
+# Who gets a reminder: real (numeric) chats, not the TEST user, and not yet at
+# TARGET_COUNT for that period. The same expressions are used as the predicate of
+# the partial indexes in ensure_reminder_indexes() so the planner can use them.
+REMINDER_BASE_SQL = "code IS DISTINCT FROM 'TEST' AND chat_id ~ '^-?[0-9]+$'"
+REMINDER_COUNT_COLUMN = {"morning": "morning_count", "evening": "night_count"}
+REMINDER_TIME_COLUMN = {"morning": "morning_time", "evening": "evening_time"}
+
+def reminder_target_filter(period, bucket=None):
+    """Return (where, params) selecting participants who still need the `period` reminder.
+
+    `bucket` is an optional (timezone, time) pair restricting it to one scheduling bucket.
+    """
+    column = REMINDER_COUNT_COLUMN[period]
+    where = f"{REMINDER_BASE_SQL} AND {column} < %s"
+    params = (TARGET_COUNT,)
+    if bucket is not None:
+        where += f" AND timezone = %s AND {REMINDER_TIME_COLUMN[period]} = %s"
+        params += tuple(bucket)
+    return where, params
+
+def get_reminder_buckets(period):
+    """Distinct (timezone, time) pairs that still have participants to remind for `period`."""
+    where, params = reminder_target_filter(period)
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT DISTINCT timezone, {REMINDER_TIME_COLUMN[period]}
+                FROM user_codes
+                WHERE {where}
+            """, params)
+            return cur.fetchall()
+
+def like_escape(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def get_code_page_rows(columns, search="", after_id=None, before_id=None, limit=CODE_PAGE_SIZE):
+    """One page of participants (`columns` of each) in (code byte order, id), optionally only codes starting with `search`.
+
+    Keyset pagination: pass `after_id` (id of the last participant on the current
+    page) for the next page or `before_id` (the first one's) for the previous one.
+    Returns (rows, has_prev, has_next).
+    """
+    conditions = ["code IS NOT NULL"]
+    params = []
+    if search:
+        conditions.append('code COLLATE "C" LIKE %s')
+        params.append(like_escape(search) + "%")
+    anchor = 'SELECT code COLLATE "C", id FROM user_codes WHERE id = %s'
+    backwards = before_id is not None
+    if backwards:
+        conditions.append(f'(code COLLATE "C", id) < ({anchor})')
+        params.append(before_id)
+    elif after_id is not None:
+        conditions.append(f'(code COLLATE "C", id) > ({anchor})')
+        params.append(after_id)
+    order = "DESC" if backwards else "ASC"
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT {", ".join(columns)} FROM user_codes
+                WHERE {" AND ".join(conditions)}
+                ORDER BY code COLLATE "C" {order}, id {order}
+                LIMIT %s
+            """, params + [limit + 1])
+            rows = cur.fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+        return rows, more, True
+    return rows, after_id is not None, more
+
+def get_progress_summary():
+    """Totals, a completion histogram and the participants furthest behind, all aggregated in SQL."""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                WITH p AS (
+                    SELECT code, morning_count, night_count,
+                           LEAST(morning_count, %(t)s) + LEAST(night_count, %(t)s) AS done_entries
+                    FROM user_codes
+                )
+                SELECT COUNT(*),
+                       COUNT(*) FILTER (WHERE morning_count >= %(t)s AND night_count >= %(t)s),
+                       COALESCE(SUM(morning_count), 0),
+                       COALESCE(SUM(night_count), 0),
+                       COALESCE(AVG(done_entries), 0)
+                FROM p
+            """, {"t": TARGET_COUNT})
+            total, completed, morning, evening, avg_entries = cur.fetchone()
+            cur.execute("""
+                SELECT width_bucket(LEAST(morning_count, %(t)s) + LEAST(night_count, %(t)s), 0, %(full)s, 4) AS b,
+                       COUNT(*)
+                FROM user_codes
+                GROUP BY b
+                ORDER BY b
+            """, {"t": TARGET_COUNT, "full": 2 * TARGET_COUNT})
+            histogram = dict(cur.fetchall())
+            cur.execute("""
+                SELECT code, morning_count, night_count, COUNT(*) OVER ()
+                FROM user_codes
+                WHERE LEAST(morning_count, %(t)s) + LEAST(night_count, %(t)s) < %(cutoff)s
+                ORDER BY morning_count + night_count, code
+                LIMIT %(limit)s
+            """, {"t": TARGET_COUNT, "cutoff": float(avg_entries) - PROGRESS_BEHIND_MARGIN,
+                  "limit": PROGRESS_BEHIND_LIST})
+            rows = cur.fetchall()
+    behind = [row[:3] for row in rows]
+    return {
+        "total": total, "completed": completed, "morning": morning, "evening": evening,
+        "avg_entries": float(avg_entries), "histogram": histogram, "behind": behind,
+        "behind_total": rows[0][3] if rows else 0,
+    }
+
+def set_user_timezone(chat_id, tz_name):
+    logger.info(f"Setting timezone for chat_id={chat_id} to {tz_name}")
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("UPDATE user_codes SET timezone=%s WHERE chat_id=%s", (tz_name, chat_id))
+            updated = cur.rowcount
+            conn.commit()
+    user_cache.invalidate(chat_id)
+    return updated > 0
+
+def set_user_reminder_time(chat_id, period, at):
+    logger.info(f"Setting {period} reminder time for chat_id={chat_id} to {at}")
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"UPDATE user_codes SET {REMINDER_TIME_COLUMN[period]}=%s WHERE chat_id=%s",
+                (at, chat_id)
+            )
+            updated = cur.rowcount
+            conn.commit()
+    user_cache.invalidate(chat_id)
+    return updated > 0
 
 def reset_user(chat_id):
     logger.info(f"Resetting user with chat_id={chat_id}")
-    user = load_user(chat_id)
-    if not user:
-        return
-    save_user(
-        chat_id,
-        user["color"],
-        user["animal"],
-        user["sport"],
-        user["age"],
-        user["code"],
-        0,
-        0
-    )
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE user_codes
+                SET morning_count=0, night_count=0
+                WHERE chat_id=%s
+            """, (chat_id,))
+            conn.commit()
+    user_cache.invalidate(chat_id)
 
 def update_user_code(chat_id, new_code):
+    """Change a participant's code. Returns False if the code belongs to someone else."""
     logger.info(f"Updating user_code for chat_id={chat_id} to new_code={new_code}")
-    user = load_user(chat_id)
-    if user:
-        save_user(
-            chat_id,
-            user["color"],
-            user["animal"],
-            user["sport"],
-            user["age"],
-            new_code,
-            user["morning_count"],
-            user["night_count"]
-        )
-
-def update_counts(chat_id, is_morning):
-    logger.debug(f"Incrementing counts for chat_id={chat_id}, is_morning={is_morning}")
-    user = load_user(chat_id)
-    if not user:
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            try:
+                cur.execute("""
+                    UPDATE user_codes
+                    SET code=%s
+                    WHERE chat_id=%s
+                """, (new_code, chat_id))
+            except pg_errors.UniqueViolation:
+                conn.rollback()
+                logger.warning(f"Code {new_code} is already taken, not assigning it to chat_id={chat_id}")
+                return False
+            conn.commit()
+    user_cache.invalidate(chat_id)
+    return True
+
+def register_user(chat_id, color, animal, sport, age, base_code):
+    """Save a new registration under base_code, or base_code-2, -3, ... if it is taken. Returns the code."""
+    logger.debug(f"Registering chat_id={chat_id} with base code={base_code}")
+    like = like_escape(base_code) + "-%"
+    for _ in range(MAX_CODE_ATTEMPTS):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                try:
+                    # The check and the insert share one transaction; the lock makes
+                    # registrations for the same base code take turns, so the codes stay
+                    # distinct even without the unique index (UNIQUE_CODES=0).
+                    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (base_code,))
+                    cur.execute("""
+                        SELECT code FROM user_codes
+                        WHERE (code=%s OR code LIKE %s) AND chat_id<>%s
+                    """, (base_code, like, chat_id))
+                    taken = {r[0] for r in cur.fetchall()}
+                    code = base_code
+                    n = 2
+                    while code in taken:
+                        code = f"{base_code}-{n}"
+                        n += 1
+                    cur.execute("""
+                        INSERT INTO user_codes (chat_id, color, animal, sport, age, code, morning_count, night_count)
+                        VALUES (%s, %s, %s, %s, %s, %s, 0, 0)
+                        ON CONFLICT (chat_id) DO UPDATE
+                          SET color=EXCLUDED.color,
+                              animal=EXCLUDED.animal,
+                              sport=EXCLUDED.sport,
+                              age=EXCLUDED.age,
+                              code=EXCLUDED.code,
+                              morning_count=0,
+                              night_count=0
+                    """, (chat_id, color, animal, sport, age, code))
+                    conn.commit()
+                except pg_errors.UniqueViolation:
+                    # A code changed by /admin or "Update Code" can still collide; pick again.
+                    conn.rollback()
+                    logger.info(f"Code {code} was taken concurrently, retrying.")
+                    continue
+        user_cache.invalidate(chat_id)
+        return code
+    raise RuntimeError(f"Could not allocate a unique code for base={base_code}")
+
+def update_counts(chat_id, is_morning, callback_id=None, dedup_key=None):
+    """Log a diary entry and increment its counter in one transaction.
+
+    If `dedup_key` was already recorded nothing is written and the current counts
+    are returned instead. Returns (m_count, n_count, is_done, duplicate).
+    """
+    logger.debug(f"Incrementing counts for chat_id={chat_id}, is_morning={is_morning}, dedup_key={dedup_key}")
+    column = "morning_count" if is_morning else "night_count"
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            if dedup_key is not None:
+                cur.execute("""
+                    INSERT INTO entry_dedup (dedup_key, chat_id) VALUES (%s, %s)
+                    ON CONFLICT (dedup_key) DO NOTHING
+                    RETURNING 1
+                """, (dedup_key, chat_id))
+                if cur.fetchone() is None:
+                    conn.rollback()
+                    logger.info(f"Duplicate entry {dedup_key} ignored.")
+                    cur.execute("SELECT morning_count, night_count FROM user_codes WHERE chat_id=%s", (chat_id,))
+                    row = cur.fetchone() or (0, 0)
+                    conn.rollback()
+                    m_count, n_count = row
+                    return (m_count, n_count, m_count >= TARGET_COUNT and n_count >= TARGET_COUNT, True)
+            cur.execute(f"""
+                UPDATE user_codes
+                SET {column} = {column} + 1
+                WHERE chat_id=%s
+                RETURNING morning_count, night_count
+            """, (chat_id,))
+            row = cur.fetchone()
+            if row:
+                cur.execute("""
+                    INSERT INTO diary_entries (chat_id, entry_type, callback_id)
+                    VALUES (%s, %s, %s)
+                """, (chat_id, "morning" if is_morning else "evening", callback_id))
+                conn.commit()
+            else:
+                conn.rollback()
+    if not row:
         logger.warning(f"No user found with chat_id={chat_id}, cannot update counts.")
-        return (0, 0, False)
-    m_count = user["morning_count"]
-    n_count = user["night_count"]
-    if is_morning:
-        m_count += 1
-    else:
-        n_count += 1
-    save_user(
-        chat_id,
-        user["color"],
-        user["animal"],
-        user["sport"],
-        user["age"],
-        user["code"],
-        m_count,
-        n_count
-    )
+        user_cache.invalidate(chat_id)
+        return (0, 0, False, False)
+    m_count, n_count = row
+    user_cache.update_counts(chat_id, m_count, n_count)
     is_done = (m_count >= TARGET_COUNT and n_count >= TARGET_COUNT)
-    return (m_count, n_count, is_done)
+    return (m_count, n_count, is_done, False)
+
+#############################
+# Async Data Access
+#############################
+
+# The psycopg2 helpers above block, so handlers and jobs reach them through a
+# dedicated thread pool sized to the connection pool. That keeps the event loop
+# free to process other participants' updates while a query is in flight.
+_db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix="db")
+
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
+async def load_user_async(chat_id):
+    return await run_db(load_user, chat_id)
+
+async def load_user_by_code_async(codename):
+    return await run_db(load_user_by_code, codename)
+
+async def load_user_by_id_async(participant_id):
+    return await run_db(load_user_by_id, participant_id)
+
+async def reset_user_async(chat_id):
+    return await run_db(reset_user, chat_id)
+
+async def update_user_code_async(chat_id, new_code):
+    return await run_db(update_user_code, chat_id, new_code)
+
+async def register_user_async(chat_id, color, animal, sport, age, base_code):
+    return await run_db(register_user, chat_id, color, animal, sport, age, base_code)
+
+async def update_counts_async(chat_id, is_morning, callback_id=None, dedup_key=None):
+    return await run_db(update_counts, chat_id, is_morning, callback_id, dedup_key)
+
+#############################
+# Persistence
+#############################
+
+# context.user_data and the registration ConversationHandler survive restarts via
+# PostgresPersistence. PTB hands over changed entries every PERSISTENCE_FLUSH_SECONDS;
+# they are buffered and written in one transaction per round instead of one write
+# per update. user_data is read lazily, the first time a user is seen after start.
+
+def load_persisted_user_data(user_id):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT data FROM bot_user_data WHERE user_id = %s", (user_id,))
+            row = cur.fetchone()
+    return row[0] if row else None
+
+def load_persisted_conversations(name):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT key, state FROM bot_conversations WHERE name = %s", (name,))
+            return {tuple(key): state for key, state in cur.fetchall()}
+
+def write_persistence_batch(user_rows, dropped_users, conversation_rows, ended_conversations):
+    """Write one flush round in a single transaction.
+
+    user_rows: {user_id: data}; dropped_users: user ids;
+    conversation_rows: {(name, key): state}; ended_conversations: (name, key) pairs.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            if user_rows:
+                execute_values(cur, """
+                    INSERT INTO bot_user_data (user_id, data) VALUES %s
+                    ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = now()
+                """, [(user_id, Json(data)) for user_id, data in user_rows.items()])
+            if dropped_users:
+                cur.execute("DELETE FROM bot_user_data WHERE user_id = ANY(%s)", (list(dropped_users),))
+            if conversation_rows:
+                execute_values(cur, """
+                    INSERT INTO bot_conversations (name, key, state) VALUES %s
+                    ON CONFLICT (name, key) DO UPDATE SET state = EXCLUDED.state, updated_at = now()
+                """, [(name, list(key), Json(state)) for (name, key), state in conversation_rows.items()])
+            for name, key in ended_conversations:
+                cur.execute("DELETE FROM bot_conversations WHERE name = %s AND key = %s::bigint[]", (name, list(key)))
+        conn.commit()
+
+class PostgresPersistence(BasePersistence):
+    """BasePersistence storing user_data and conversation states in Postgres.
+
+    The update_* callbacks only record the latest value per key; flush_pending()
+    writes everything recorded so far as one batch. A write is scheduled as soon
+    as PTB starts handing over a round, so a round becomes one transaction.
+    chat_data, bot_data and callback_data are not used by this bot and not stored.
+    """
+
+    def __init__(self, update_interval=PERSISTENCE_FLUSH_SECONDS):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._loaded_users = set()
+        self._user_rows = {}
+        self._dropped_users = set()
+        self._conversation_rows = {}
+        self._ended_conversations = set()
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._retry_handle = None
+        self._retry_delay = 0.0
+        self.flushes = 0
+        self.rows_written = 0
+        self.last_flush_ms = 0.0
+        self.failures = 0
+
+    @property
+    def pending(self):
+        return (len(self._user_rows) + len(self._dropped_users)
+                + len(self._conversation_rows) + len(self._ended_conversations))
+
+    # Reads
+
+    async def get_user_data(self):
+        return {}  # loaded per user in refresh_user_data
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        conversations = await run_db(load_persisted_conversations, name)
+        logger.info(f"Restored {len(conversations)} '{name}' conversation(s) from the database.")
+        return conversations
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._loaded_users:
+            return
+        data = await run_db(load_persisted_user_data, user_id)
+        self._loaded_users.add(user_id)
+        for key, value in (data or {}).items():
+            user_data.setdefault(key, value)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # Writes (buffered)
+
+    async def update_user_data(self, user_id, data):
+        self._dropped_users.discard(user_id)
+        self._user_rows[user_id] = data
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._user_rows.pop(user_id, None)
+        self._dropped_users.add(user_id)
+        self._loaded_users.discard(user_id)
+        self._schedule_flush()
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            self._conversation_rows.pop((name, key), None)
+            self._ended_conversations.add((name, key))
+        else:
+            self._ended_conversations.discard((name, key))
+            self._conversation_rows[(name, key)] = new_state
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    def _schedule_flush(self):
+        # PTB gathers all update_* calls of a round at once; none of them await, so
+        # the task created by the first one runs after the whole round is buffered.
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush_pending())
+
+    async def flush_pending(self):
+        async with self._flush_lock:
+            if not self.pending:
+                return
+            user_rows, self._user_rows = self._user_rows, {}
+            dropped_users, self._dropped_users = self._dropped_users, set()
+            conversation_rows, self._conversation_rows = self._conversation_rows, {}
+            ended, self._ended_conversations = self._ended_conversations, set()
+            rows = len(user_rows) + len(dropped_users) + len(conversation_rows) + len(ended)
+            started = time.perf_counter()
+            try:
+                await run_db(write_persistence_batch, user_rows, dropped_users, conversation_rows, ended)
+            except Exception as e:
+                # Put the batch back unless a newer value arrived meanwhile; the next round retries it.
+                self.failures += 1
+                logger.error(f"Persistence flush of {rows} row(s) failed: {e}")
+                for user_id, data in user_rows.items():
+                    if user_id not in self._dropped_users:
+                        self._user_rows.setdefault(user_id, data)
+                self._dropped_users |= {u for u in dropped_users if u not in self._user_rows}
+                for key, state in conversation_rows.items():
+                    if key not in self._ended_conversations:
+                        self._conversation_rows.setdefault(key, state)
+                self._ended_conversations |= {k for k in ended if k not in self._conversation_rows}
+                self._schedule_retry()
+                return
+            self._retry_delay = 0.0
+            self.flushes += 1
+            self.rows_written += rows
+            self.last_flush_ms = (time.perf_counter() - started) * 1000
+
+    def _schedule_retry(self):
+        # PTB only hands over dirty entries, so in a quiet period nothing else would
+        # write the requeued batch; retry on our own, backing off up to the cap.
+        if self._retry_handle is not None and not self._retry_handle.cancelled():
+            self._retry_handle.cancel()
+        self._retry_delay = min(max(self._retry_delay * 2, 1.0), PERSISTENCE_RETRY_MAX_SECONDS)
+        logger.info(f"Retrying the persistence flush in {self._retry_delay:.0f}s.")
+        self._retry_handle = asyncio.get_running_loop().call_later(self._retry_delay, self._schedule_flush)
+
+    async def flush(self):
+        if self._retry_handle is not None:
+            self._retry_handle.cancel()
+            self._retry_handle = None
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self.flush_pending()
+
+    def stats_text(self):
+        return (
+            "Persistence:\n"
+            f"Flushes: {self.flushes} ({self.rows_written} rows, last {self.last_flush_ms:.1f} ms, "
+            f"{self.failures} failed)\n"
+            f"Pending: {self.pending}, users loaded: {len(self._loaded_users)}"
+        )
+
+bot_persistence = PostgresPersistence()
 
 #############################
 # Registration Flow
@@ -248,10 +1476,10 @@ REG_COLOR, REG_ANIMAL, REG_SPORT, REG_AGE = range(4)
 async def start_registration(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("/start command triggered for chat_id=%s", update.effective_chat.id)
     chat_id = str(update.effective_chat.id)
-    user_data = load_user(chat_id)
+    user_data = await load_user_async(chat_id)
 
-    if user_data and user_data["color"] != "":
-        code = user_data["code"]
+    if user_data and user_data.color != "":
+        code = user_data.code
         keyboard = [
             [InlineKeyboardButton("Continue Diary Study", callback_data="cont_diary")],
             [InlineKeyboardButton("Restart Diary Study", callback_data="restart_diary")],
@@ -282,7 +1510,7 @@ async def handle_start_buttons(update: Update, context: ContextTypes.DEFAULT_TYP
             "Great! You can wait for the next reminder or type /done if you have an ongoing entry."
         )
     elif choice == "restart_diary":
-        reset_user(chat_id)
+        await reset_user_async(chat_id)
         await query.edit_message_text(
             "Your diary study has been restarted! All your morning/night counts are now 0.\n"
             "You can wait for the next reminder to start submitting entries again."
@@ -291,7 +1519,7 @@ async def handle_start_buttons(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.edit_message_text(
             "Please type your new code in the chat."
         )
-        context.user_data["change_code_from_start"] = True
+        chat_states.set(chat_id, "change_code")
 
 async def reg_color(update: Update, context: ContextTypes.DEFAULT_TYPE):
     color = update.message.text.strip()
@@ -334,12 +1562,15 @@ async def reg_age(update: Update, context: ContextTypes.DEFAULT_TYPE):
     color = context.user_data["color"]
     animal = context.user_data["animal"]
     sport = context.user_data["sport"]
-    code = f"{color[0].upper()}{animal[0].upper()}{sport[0].upper()}{age_str}"
-    save_user(chat_id, color, animal, sport, age_str, code, 0, 0)
+    base_code = f"{color[0].upper()}{animal[0].upper()}{sport[0].upper()}{age_str}"
+    code = await register_user_async(chat_id, color, animal, sport, age_str, base_code)
+
+    await run_db(refresh_reminder_buckets, context.application)
 
     await update.message.reply_text(
         f"Registration complete! Your code is: {code}\n"
-        "We’ll send reminders at 8:00 AM and 6:00 PM local time. Stay tuned!"
+        "We’ll send reminders at 8:00 AM and 6:00 PM (Singapore time). Stay tuned!\n"
+        "Use /timezone and /remindertime to change when you get them."
     )
     return ConversationHandler.END
 
@@ -349,108 +1580,1062 @@ async def reg_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 #############################
-# Reminders & Storing Counts
+# Participant Reminder Settings
 #############################
 
-def store_current_counts(period):
-    logger.info(f"Storing current counts for period={period}")
-    all_users = get_all_users()
-    if period == "morning":
-        last_reminder_counts["morning"] = {u["chat_id"]: u["morning_count"] for u in all_users}
-    else:
-        last_reminder_counts["evening"] = {u["chat_id"]: u["night_count"] for u in all_users}
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = str(update.effective_chat.id)
+    logger.info(f"/timezone command triggered for chat_id={chat_id}")
+    user = await load_user_async(chat_id)
+    if not user:
+        await update.message.reply_text("You’re not registered. Please use /start.")
+        return
+    if not context.args:
+        await update.message.reply_text(
+            f"Your timezone is {user.timezone}.\n"
+            "To change it, send e.g. /timezone Europe/London"
+        )
+        return
+    try:
+        tz_name = pytz.timezone(context.args[0]).zone
+    except pytz.UnknownTimeZoneError:
+        await update.message.reply_text(
+            f"Unknown timezone '{context.args[0]}'. Please use a name like Asia/Singapore or Europe/London."
+        )
+        return
+    await run_db(set_user_timezone, chat_id, tz_name)
+    await run_db(refresh_reminder_buckets, context.application)
+    await update.message.reply_text(f"Your timezone is now {tz_name}.")
 
-async def morning_reminder(context: ContextTypes.DEFAULT_TYPE):
-    logger.info("morning_reminder job triggered.")
+async def remindertime_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = str(update.effective_chat.id)
+    logger.info(f"/remindertime command triggered for chat_id={chat_id}")
+    user = await load_user_async(chat_id)
+    if not user:
+        await update.message.reply_text("You’re not registered. Please use /start.")
+        return
+    usage = (
+        f"Your reminders are at {user.morning_time.strftime('%H:%M')} (morning) and "
+        f"{user.evening_time.strftime('%H:%M')} (evening), {user.timezone}.\n"
+        "To change one, send e.g. /remindertime morning 07:30"
+    )
+    if len(context.args) != 2 or context.args[0].lower() not in REMINDER_TIME_COLUMN:
+        await update.message.reply_text(usage)
+        return
+    period = context.args[0].lower()
     try:
-        all_users = get_all_users()
-        for u in all_users:
-            chat_id_str = u["chat_id"]
-            code = u["code"]
-            # <<< ADDED: skip if chat_id not numeric >>>
+        at = round_reminder_time(parse_bucket_time(context.args[1]))
+    except ValueError:
+        await update.message.reply_text("Please give the time as HH:MM, e.g. 07:30.")
+        return
+    await run_db(set_user_reminder_time, chat_id, period, at)
+    await run_db(refresh_reminder_buckets, context.application)
+    await update.message.reply_text(
+        f"Your {period} reminder is now at {at.strftime('%H:%M')} ({user.timezone})."
+    )
+
+#############################
+# Fan-out Engine
+#############################
+
+class RateLimiter:
+    """Token bucket for the global send rate plus minimum spacing per chat and a shared flood pause."""
+
+    def __init__(self, rate, per_chat_interval):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.per_chat_interval = per_chat_interval
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._chat_next = {}  # chat_id -> monotonic time of the next allowed send
+
+    async def pause(self, seconds):
+        """Stop every sender for `seconds` (Telegram RetryAfter applies to the whole bot)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _prune(self, now):
+        if len(self._chat_next) > 10000:
+            self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+
+    async def _take(self):
+        """Take one token from the global bucket; returns 0 on success, else seconds to wait."""
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    async def acquire(self, chat_id):
+        while True:
+            now = time.monotonic()
+            wait = self._paused_until - now
+            chat_wait = self._chat_next.get(chat_id, 0.0) - now
+            if wait <= 0 and chat_wait <= 0:
+                wait = await self._take()
+                if wait <= 0:
+                    now = time.monotonic()
+                    self._chat_next[chat_id] = now + self.per_chat_interval
+                    self._prune(now)
+                    return
+            await asyncio.sleep(max(wait, chat_wait, 0.001))
+
+# The bucket lives in the send_rate row so that all workers together stay under
+# FANOUT_GLOBAL_RATE. Tokens are granted a few at a time to keep it to a handful
+# of queries per second; a RetryAfter pause is shared through the same row.
+
+def take_send_tokens(name, want, rate, capacity):
+    """Take up to `want` tokens from the shared bucket `name`; returns (granted, seconds to wait if none)."""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                WITH s AS (
+                    SELECT LEAST(%(capacity)s, tokens + EXTRACT(EPOCH FROM clock_timestamp() - updated_at) * %(rate)s) AS available,
+                           COALESCE(EXTRACT(EPOCH FROM paused_until - clock_timestamp()), 0) AS paused_for
+                    FROM send_rate WHERE name = %(name)s
+                    FOR UPDATE
+                ), g AS (
+                    SELECT available, paused_for,
+                           CASE WHEN paused_for > 0 THEN 0
+                                ELSE LEAST(%(want)s, FLOOR(GREATEST(available, 0)))::INT END AS granted
+                    FROM s
+                )
+                UPDATE send_rate
+                SET tokens = g.available - g.granted, updated_at = clock_timestamp()
+                FROM g
+                WHERE name = %(name)s
+                RETURNING g.granted, g.available, g.paused_for
+            """, {"name": name, "want": want, "rate": rate, "capacity": capacity})
+            row = cur.fetchone()
+            conn.commit()
+    if row is None:
+        raise RuntimeError(f"send_rate row {name!r} is missing")
+    granted, available, paused_for = row
+    if granted:
+        return granted, 0.0
+    return 0, float(paused_for) if paused_for > 0 else (1 - float(available)) / rate
+
+def pause_send_rate(name, seconds):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE send_rate
+                SET paused_until = GREATEST(paused_until, clock_timestamp() + make_interval(secs => %s))
+                WHERE name = %s
+            """, (seconds, name))
+            conn.commit()
+
+class SharedRateLimiter(RateLimiter):
+    """RateLimiter whose global bucket and flood pause are shared by all processes through Postgres.
+
+    Per-chat spacing stays local. If the database cannot be reached the
+    process falls back to its own bucket rather than stop sending.
+    """
+
+    def __init__(self, rate, per_chat_interval, name="telegram", chunk=None):
+        super().__init__(rate, per_chat_interval)
+        self.name = name
+        self.chunk = chunk or max(1, int(rate // 5))
+        self._reserved = 0
+        self._refill_lock = asyncio.Lock()
+
+    async def _take(self):
+        async with self._refill_lock:
+            if self._reserved <= 0:
+                try:
+                    granted, wait = await run_db(take_send_tokens, self.name, self.chunk, self.rate, self.capacity)
+                except Exception as e:
+                    logger.warning(f"Shared send rate unavailable ({e}); using this worker's own limit.")
+                    return await super()._take()
+                if not granted:
+                    return wait
+                self._reserved = granted
+            self._reserved -= 1
+            return 0.0
+
+    async def pause(self, seconds):
+        await super().pause(seconds)
+        self._reserved = 0
+        try:
+            await run_db(pause_send_rate, self.name, seconds)
+        except Exception as e:
+            logger.warning(f"Could not share flood pause of {seconds}s: {e}")
+
+rate_limiter = SharedRateLimiter(FANOUT_GLOBAL_RATE, FANOUT_PER_CHAT_INTERVAL)
+
+class FanOutResult:
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self.duration = 0.0
+        self.errors = []  # (chat_id, error) of the first few failures
+
+    def summary(self):
+        rate = self.sent / self.duration if self.duration else 0.0
+        text = (f"sent {self.sent}, failed {self.failed}, skipped {self.skipped} "
+                f"in {self.duration:.1f}s ({rate:.1f} msg/s)")
+        if self.errors:
+            text += "\nFirst failures:\n" + "\n".join(f"{c}: {e}" for c, e in self.errors)
+        return text
+
+async def send_with_retry(bot, limiter=None, **kwargs):
+    """Send one message under the rate limiter, backing off on RetryAfter and transient network errors."""
+    limiter = limiter or rate_limiter
+    chat_id = kwargs["chat_id"]
+    for attempt in range(FANOUT_MAX_RETRIES + 1):
+        await limiter.acquire(chat_id)
+        try:
+            return await bot.send_message(**kwargs)
+        except RetryAfter as e:
+            logger.warning(f"Flood control hit sending to {chat_id}, pausing {e.retry_after}s")
+            await limiter.pause(e.retry_after)
+            if attempt == FANOUT_MAX_RETRIES:
+                raise
+        except (BadRequest, Forbidden):
+            raise  # permanent: chat not found, bot blocked, ...
+        except NetworkError as e:
+            if attempt == FANOUT_MAX_RETRIES:
+                raise
+            delay = 2 ** attempt
+            logger.warning(f"Network error sending to {chat_id} ({e}), retrying in {delay}s")
+            await asyncio.sleep(delay)
+
+async def fan_out(bot, messages, concurrency=FANOUT_CONCURRENCY, limiter=None, on_result=None):
+    """Send send_message kwargs from `messages` (a sync or async iterable) with bounded concurrency.
+
+    A kwargs value of None counts as skipped. Failures are isolated per recipient.
+    `on_result(kwargs, message, error)` is awaited after every attempt if given.
+    """
+    result = FanOutResult()
+    start = time.perf_counter()
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker():
+        while True:
+            kwargs = await queue.get()
+            if kwargs is None:
+                return
+            message, error = None, None
             try:
-                chat_id_int = int(chat_id_str)
-            except ValueError:
-                logger.warning(f"Skipping non-numeric chat_id={chat_id_str}")
-                continue
+                message = await send_with_retry(bot, limiter, **kwargs)
+                result.sent += 1
+            except Exception as e:
+                error = e
+                result.failed += 1
+                if len(result.errors) < 5:
+                    result.errors.append((kwargs["chat_id"], e))
+                logger.error(f"Failed to send to {kwargs['chat_id']}: {e}")
+            if on_result:
+                try:
+                    await on_result(kwargs, message, error)
+                except Exception as e:
+                    logger.error(f"fan_out on_result callback failed: {e}")
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        if hasattr(messages, "__aiter__"):
+            async for kwargs in messages:
+                if kwargs is None:
+                    result.skipped += 1
+                else:
+                    await queue.put(kwargs)
+        else:
+            for kwargs in messages:
+                if kwargs is None:
+                    result.skipped += 1
+                else:
+                    await queue.put(kwargs)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for w in workers:
+            w.cancel()
+        result.duration = time.perf_counter() - start
+    return result
 
-            # <<< ADDED: skip if code == "TEST" >>>
-            if code == "TEST":
-                logger.info("Skipping real DB reminder for code=TEST (test user).")
-                continue
+#############################
+# Outbox
+#############################
 
-            keyboard = [
-                [InlineKeyboardButton("Complete Morning Entry", callback_data=f"morning_{code}")],
-                [InlineKeyboardButton("Contact Admin", callback_data=f"contactadmin_{code}")]
-            ]
-            markup = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_message(
-                chat_id=chat_id_int,
-                text=(
-                    f"Good morning!\n"
-                    f"You are {code}, right?\n"
-                    "Click below to fill your morning diary or contact admin."
-                ),
-                reply_markup=markup
-            )
-        store_current_counts("morning")
+# Participant-facing messages are written to the outbox table first and sent by
+# the OutboxDispatcher. A crash mid fan-out therefore loses nothing: the
+# dispatcher resumes from the rows still pending, and UNIQUE (job_key, chat_id)
+# makes re-running a job a no-op instead of a double send.
+
+def outbox_payload(kwargs):
+    payload = {}
+    for key, value in kwargs.items():
+        if key == "chat_id":
+            continue
+        payload[key] = value.to_dict() if key == "reply_markup" and value is not None else value
+    return payload
+
+def outbox_kwargs(chat_id, payload, bot):
+    kwargs = dict(payload)
+    kwargs["chat_id"] = chat_id
+    if kwargs.get("reply_markup") is not None:
+        kwargs["reply_markup"] = InlineKeyboardMarkup.de_json(kwargs["reply_markup"], bot)
+    return kwargs
+
+def _insert_outbox_rows(cur, rows):
+    execute_values(cur, """
+        INSERT INTO outbox (job_key, chat_id, payload, priority)
+        VALUES %s
+        ON CONFLICT (job_key, chat_id) DO NOTHING
+    """, rows, page_size=len(rows))
+    return cur.rowcount
+
+def enqueue_messages(cur, job_key, messages, priority=0):
+    """Insert send_message kwargs into the outbox in batches on `cur`; the caller commits.
+
+    Rows with a higher `priority` are claimed before all lower ones still pending.
+    """
+    queued = 0
+    rows = []
+    for kwargs in messages:
+        rows.append((job_key, kwargs["chat_id"], Json(outbox_payload(kwargs)), priority))
+        if len(rows) >= OUTBOX_BATCH_SIZE:
+            queued += _insert_outbox_rows(cur, rows)
+            rows = []
+    if rows:
+        queued += _insert_outbox_rows(cur, rows)
+    logger.info(f"Queued {queued} message(s) for job {job_key}")
+    return queued
+
+def enqueue_single(job_key, kwargs, priority=0):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            queued = enqueue_messages(cur, job_key, [kwargs], priority)
+            conn.commit()
+    return queued
+
+def enqueue_broadcast(job_key, text):
+    """Queue `text` for every numeric chat in one INSERT ... SELECT."""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO outbox (job_key, chat_id, payload)
+                SELECT %s, chat_id::BIGINT, %s
+                FROM user_codes
+                WHERE chat_id ~ '^-?[0-9]+$'
+                ON CONFLICT (job_key, chat_id) DO NOTHING
+            """, (job_key, Json({"text": text})))
+            queued = cur.rowcount
+            conn.commit()
+    logger.info(f"Queued {queued} message(s) for job {job_key}")
+    return queued
+
+def claim_outbox_batch(limit, worker_id=WORKER_ID):
+    """Lease up to `limit` rows to this worker.
+
+    Pending rows and rows whose lease expired (their worker died mid-send) are
+    both claimable; SKIP LOCKED lets several workers claim disjoint batches at once.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE outbox
+                SET status = 'sending',
+                    attempts = attempts + 1,
+                    claimed_by = %s,
+                    lease_until = now() + make_interval(secs => %s)
+                WHERE id IN (
+                    SELECT id FROM outbox
+                    WHERE status = 'pending'
+                       OR (status = 'sending' AND lease_until < now())
+                    ORDER BY priority DESC, id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, chat_id, payload, attempts, priority
+            """, (worker_id, OUTBOX_LEASE_SECONDS, limit))
+            rows = cur.fetchall()
+            conn.commit()
+    rows.sort(key=lambda r: (-r[4], r[0]))
+    retried = sum(1 for r in rows if r[3] > 1)
+    if retried:
+        logger.warning(f"Worker {worker_id} took over {retried} outbox row(s) from an expired lease.")
+    return [(row_id, chat_id, payload) for row_id, chat_id, payload, _, _ in rows]
+
+def record_outbox_results(results, worker_id=WORKER_ID):
+    """results: list of (id, message_id, error). Rows without an error are marked sent.
+
+    Only rows still leased to `worker_id` are updated, so a worker that lost its
+    lease cannot overwrite the outcome recorded by the worker that took over.
+    """
+    if not results:
+        return
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            execute_values(cur, """
+                UPDATE outbox o
+                SET status = CASE WHEN r.error IS NULL THEN 'sent' ELSE 'failed' END,
+                    message_id = r.message_id,
+                    error = r.error,
+                    sent_at = CASE WHEN r.error IS NULL THEN now() END,
+                    lease_until = NULL
+                FROM (VALUES %s) AS r(id, message_id, error, worker)
+                WHERE o.id = r.id AND o.claimed_by = r.worker AND o.status IN ('sending', 'cancelled')
+            """, [tuple(r) + (worker_id,) for r in results],
+                template="(%s::BIGINT, %s::BIGINT, %s::TEXT, %s::TEXT)", page_size=len(results))
+            conn.commit()
+
+def renew_outbox_leases(row_ids, worker_id=WORKER_ID):
+    """Extend the lease on rows this worker is still sending; returns how many it still holds."""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE outbox
+                SET lease_until = now() + make_interval(secs => %s)
+                WHERE id = ANY(%s) AND claimed_by = %s AND status = 'sending'
+            """, (OUTBOX_LEASE_SECONDS, list(row_ids), worker_id))
+            renewed = cur.rowcount
+            conn.commit()
+    return renewed
+
+def get_cancelled_rows(row_ids):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM outbox WHERE id = ANY(%s) AND status = 'cancelled'", (list(row_ids),))
+            return {row[0] for row in cur.fetchall()}
+
+def purge_outbox():
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                DELETE FROM outbox
+                WHERE status IN ('sent', 'failed', 'cancelled')
+                  AND created_at < now() - make_interval(days => %s)
+            """, (OUTBOX_RETENTION_DAYS,))
+            purged = cur.rowcount
+            conn.commit()
+    logger.info(f"Purged {purged} old outbox row(s).")
+
+def purge_entry_dedup():
+    """Drop dedup keys past DEDUP_RETENTION_DAYS; done_button_handler only records today's forms, so none can repeat."""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                DELETE FROM entry_dedup
+                WHERE created_at < now() - make_interval(days => %s)
+            """, (DEDUP_RETENTION_DAYS,))
+            purged = cur.rowcount
+            conn.commit()
+    logger.info(f"Purged {purged} old entry dedup key(s).")
+
+class OutboxJobStats:
+    def __init__(self, counts, duration):
+        self.pending = counts.get("pending", 0)
+        self.sending = counts.get("sending", 0)
+        self.sent = counts.get("sent", 0)
+        self.failed = counts.get("failed", 0)
+        self.cancelled = counts.get("cancelled", 0)
+        self.total = sum(counts.values())
+        self.duration = duration
+
+    @property
+    def done(self):
+        return self.pending == 0 and self.sending == 0
+
+    def summary(self):
+        rate = self.sent / self.duration if self.duration else 0.0
+        text = f"sent {self.sent}, failed {self.failed}"
+        if self.cancelled:
+            text += f", cancelled {self.cancelled}"
+        if not self.done:
+            text += f", remaining {self.pending + self.sending}"
+        return text + f" in {self.duration:.1f}s ({rate:.1f} msg/s)"
+
+def get_outbox_job_stats(job_key):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT status, COUNT(*), MIN(created_at), MAX(sent_at)
+                FROM outbox
+                WHERE job_key = %s
+                GROUP BY status
+            """, (job_key,))
+            rows = cur.fetchall()
+    counts = {status: n for status, n, _, _ in rows}
+    started = min((r[2] for r in rows), default=None)
+    finished = max((r[3] for r in rows if r[3]), default=None)
+    duration = (finished - started).total_seconds() if started and finished else 0.0
+    return OutboxJobStats(counts, duration)
+
+def cancel_outbox_job(job_key):
+    """Stop a job: every row not yet delivered is marked cancelled.
+
+    Claimed rows are included; dispatchers re-check their batch as they go and
+    skip cancelled rows. A message already handed to Telegram is still recorded
+    as sent or failed.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE outbox SET status = 'cancelled'
+                WHERE job_key = %s AND status IN ('pending', 'sending')
+            """, (job_key,))
+            cancelled = cur.rowcount
+            conn.commit()
+    logger.info(f"Cancelled {cancelled} pending message(s) of job {job_key}")
+    return cancelled
+
+async def wait_for_outbox_job(job_key, timeout=None, poll=1.0):
+    """Wait until every row of `job_key` is sent or failed (or `timeout` elapses); returns its stats."""
+    deadline = time.monotonic() + timeout if timeout else None
+    while True:
+        stats = await run_db(get_outbox_job_stats, job_key)
+        if stats.done or (deadline and time.monotonic() >= deadline):
+            return stats
+        await asyncio.sleep(poll)
+
+class OutboxDispatcher:
+    """Drains the outbox through fan_out() and records delivery status and message IDs."""
+
+    def __init__(self, bot, batch_size=OUTBOX_BATCH_SIZE, poll_interval=OUTBOX_POLL_SECONDS):
+        self.bot = bot
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def wake(self):
+        self._wake.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            try:
+                claimed = await self.dispatch_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbox dispatch failed: {e}")
+                claimed = 0
+            if claimed < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+
+    async def dispatch_once(self):
+        rows = await run_db(claim_outbox_batch, self.batch_size)
+        if not rows:
+            return 0
+        row_ids = {}
+        results = []
+
+        async def messages():
+            # Re-check each chunk after the first so a cancelled job stops mid-batch.
+            for start in range(0, len(rows), OUTBOX_RECORD_EVERY):
+                chunk = rows[start:start + OUTBOX_RECORD_EVERY]
+                cancelled = await run_db(get_cancelled_rows, [r[0] for r in chunk]) if start else set()
+                for row_id, chat_id, payload in chunk:
+                    if row_id in cancelled:
+                        yield None
+                        continue
+                    kwargs = outbox_kwargs(chat_id, payload, self.bot)
+                    row_ids[id(kwargs)] = row_id
+                    yield kwargs
+
+        async def on_result(kwargs, message, error):
+            results.append((row_ids[id(kwargs)], message.message_id if message else None,
+                            str(error) if error else None))
+            if len(results) >= OUTBOX_RECORD_EVERY:
+                batch = results[:]
+                del results[:]
+                await run_db(record_outbox_results, batch)
+
+        renewer = asyncio.create_task(self._renew_leases([r[0] for r in rows]))
+        try:
+            await fan_out(self.bot, messages(), on_result=on_result)
+            await run_db(record_outbox_results, results)
+        finally:
+            renewer.cancel()
+            await asyncio.gather(renewer, return_exceptions=True)
+        return len(rows)
+
+    async def _renew_leases(self, row_ids):
+        # A batch can outlast its lease (flood pause, slow network); keep it from being re-claimed.
+        while True:
+            await asyncio.sleep(OUTBOX_LEASE_SECONDS / 3)
+            try:
+                renewed = await run_db(renew_outbox_leases, row_ids)
+                logger.debug(f"Renewed the lease on {renewed} outbox row(s).")
+            except Exception as e:
+                logger.error(f"Could not renew outbox leases: {e}")
+
+outbox_dispatcher = None
+
+def wake_outbox_dispatcher():
+    if outbox_dispatcher is not None:
+        outbox_dispatcher.wake()
+
+async def send_via_outbox(job_key, kwargs):
+    """Queue one message ahead of bulk jobs and wake the dispatcher; does not wait for delivery.
+
+    Pair with report_delivery() in a background task to tell the sender how it went.
+    """
+    await run_db(enqueue_single, job_key, kwargs, OUTBOX_PRIORITY_INTERACTIVE)
+    wake_outbox_dispatcher()
+
+async def report_delivery(bot, job_key, message, sent_text, failed_text, timeout=OUTBOX_DELIVERY_TIMEOUT):
+    """Edit `message` (the sender's "queued" notice) once `job_key` is sent or has failed."""
+    stats = await wait_for_outbox_job(job_key, timeout=timeout)
+    if not stats.done:
+        logger.warning(f"Outbox job {job_key} still undelivered after {timeout:.0f}s: {stats.summary()}")
+        return stats
+    try:
+        await bot.edit_message_text(sent_text if stats.sent else failed_text,
+                                    chat_id=message.chat_id, message_id=message.message_id)
+    except (BadRequest, Forbidden) as e:
+        logger.warning(f"Could not report delivery of {job_key}: {e}")
+    return stats
+
+def get_outbox_stats_text():
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT claimed_by, COUNT(*), COUNT(*) FILTER (WHERE lease_until < now())
+                FROM outbox
+                WHERE status = 'sending'
+                GROUP BY claimed_by
+                ORDER BY claimed_by
+            """)
+            leased = cur.fetchall()
+            cur.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'")
+            pending = cur.fetchone()[0]
+    lines = ["Outbox:", f"Pending: {pending}"]
+    for worker, n, expired in leased:
+        lines.append(f"Sending via {worker}: {n}" + (f" ({expired} lease expired)" if expired else ""))
+    return "\n".join(lines)
+
+#############################
+# Scheduler Leader Election
+#############################
+
+def try_acquire_lease(name, holder, ttl):
+    """Take or renew the `name` lease for `holder`; returns True if `holder` now owns it."""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO leader_lease (name, holder, lease_until)
+                VALUES (%s, %s, now() + make_interval(secs => %s))
+                ON CONFLICT (name) DO UPDATE
+                    SET holder = EXCLUDED.holder, lease_until = EXCLUDED.lease_until
+                    WHERE leader_lease.holder = EXCLUDED.holder
+                       OR leader_lease.lease_until < now()
+                RETURNING holder
+            """, (name, holder, ttl))
+            row = cur.fetchone()
+            conn.commit()
+    return row is not None
+
+def release_lease(name, holder):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM leader_lease WHERE name = %s AND holder = %s", (name, holder))
+            conn.commit()
+
+def get_lease_holder(name):
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT holder, lease_until FROM leader_lease WHERE name = %s AND lease_until > now()", (name,))
+            return cur.fetchone()
+
+class LeaderElector:
+    """Keeps trying to hold a DB lease; only the holder runs the scheduled reminder jobs.
+
+    Every process schedules the same jobs, and the ones that are not leader skip
+    them when they fire. If the leader dies its lease runs out and another
+    process takes over within `ttl` seconds. Jobs are keyed per run, so the
+    short overlap while a lease changes hands cannot send anything twice.
+    """
+
+    def __init__(self, name="scheduler", holder=WORKER_ID, ttl=LEADER_LEASE_SECONDS, renew_every=LEADER_RENEW_SECONDS):
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self.renew_every = renew_every
+        self.is_leader = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self.is_leader:
+            self.is_leader = False
+            await run_db(release_lease, self.name, self.holder)
+            logger.info(f"{self.holder} released the {self.name} lease.")
+
+    async def renew(self):
+        try:
+            leader = await run_db(try_acquire_lease, self.name, self.holder, self.ttl)
+        except Exception as e:
+            logger.error(f"Could not renew the {self.name} lease: {e}")
+            leader = False
+        if leader != self.is_leader:
+            logger.info(f"{self.holder} {'acquired' if leader else 'lost'} the {self.name} lease.")
+        self.is_leader = leader
+        return leader
+
+    async def _run(self):
+        while True:
+            await self.renew()
+            await asyncio.sleep(self.renew_every)
+
+scheduler_elector = None
+
+def is_scheduler_leader():
+    """True if this process should run scheduled jobs (always, when no elector is running)."""
+    return scheduler_elector is None or scheduler_elector.is_leader
+
+async def start_background_services(application):
+    global outbox_dispatcher, scheduler_elector
+    scheduler_elector = LeaderElector()
+    await scheduler_elector.renew()
+    scheduler_elector.start()
+    outbox_dispatcher = OutboxDispatcher(application.bot)
+    outbox_dispatcher.start()
+    logger.info(f"Worker {WORKER_ID} started (role={BOT_ROLE}, leader={scheduler_elector.is_leader}).")
+
+async def stop_background_services(application):
+    if outbox_dispatcher is not None:
+        await outbox_dispatcher.stop()
+    if scheduler_elector is not None:
+        await scheduler_elector.stop()
+
+def get_worker_stats_text():
+    holder = get_lease_holder("scheduler")
+    leader = f"{holder[0]} (lease until {holder[1].astimezone(SINGAPORE_TZ).strftime('%H:%M:%S')})" if holder else "none"
+    return (f"Worker: {WORKER_ID} ({BOT_ROLE})\n"
+            f"Scheduler leader: {leader}\n\n" + get_outbox_stats_text())
+
+#############################
+# Reminders & Storing Counts
+#############################
+
+def store_current_counts(cur, period, bucket):
+    """Replace the `period` snapshot with the current count of every participant reminded."""
+    logger.info(f"Storing current counts for period={period}, bucket={bucket}")
+    column = REMINDER_COUNT_COLUMN[period]
+    where, params = reminder_target_filter(period, bucket)
+    if bucket is None:
+        cur.execute("DELETE FROM reminder_snapshots WHERE period=%s", (period,))
+    else:
+        cur.execute(f"""
+            DELETE FROM reminder_snapshots
+            WHERE period=%s
+              AND chat_id IN (
+                  SELECT chat_id FROM user_codes
+                  WHERE timezone=%s AND {REMINDER_TIME_COLUMN[period]}=%s
+              )
+        """, (period,) + tuple(bucket))
+    cur.execute(f"""
+        INSERT INTO reminder_snapshots (period, chat_id, count, taken_at)
+        SELECT %s, chat_id, {column}, now()
+        FROM user_codes
+        WHERE {where}
+        ON CONFLICT (period, chat_id) DO UPDATE
+          SET count=EXCLUDED.count,
+              taken_at=EXCLUDED.taken_at,
+              nudged_at=NULL
+    """, (period,) + params)
+    logger.info(f"Stored {cur.rowcount} {period} snapshot rows.")
+
+def parse_chat_id(chat_id_str):
+    """Telegram chat IDs are stored as TEXT; returns None for rows that aren't numeric."""
+    try:
+        return int(chat_id_str)
+    except (TypeError, ValueError):
+        logger.warning(f"Skipping non-numeric chat_id={chat_id_str}")
+        return None
+
+def bucket_label(period, bucket):
+    if bucket is None:
+        return period
+    tz_name, at = bucket
+    return f"{period} {at.strftime('%H:%M')} {tz_name}"
+
+def reminder_message(period, chat_id_int, code, participant_id=None):
+    contact = participant_callback("contactadmin_", participant_id, code)
+    if period == "morning":
+        keyboard = [
+            [InlineKeyboardButton("Complete Morning Entry",
+                                  callback_data=participant_callback("morning_", participant_id, code))],
+            [InlineKeyboardButton("Contact Admin", callback_data=contact)]
+        ]
+        text = (
+            f"Good morning!\n"
+            f"You are {code}, right?\n"
+            "Click below to fill your morning diary or contact admin."
+        )
+    else:
+        keyboard = [
+            [InlineKeyboardButton("Complete Evening Entry",
+                                  callback_data=participant_callback("evening_", participant_id, code))],
+            [InlineKeyboardButton("Contact Admin", callback_data=contact)]
+        ]
+        text = (
+            f"Good evening!\n"
+            f"You are {code}, correct?\n"
+            "Tap below to fill your evening diary or contact admin."
+        )
+    return {"chat_id": chat_id_int, "text": text, "reply_markup": InlineKeyboardMarkup(keyboard)}
+
+def run_job_key(kind, period, bucket):
+    """Outbox job key for one run of a reminder/follow-up; re-running the same day is a no-op."""
+    if bucket is None:
+        return f"{kind}:{period}:all:{datetime.now(tz=SINGAPORE_TZ).date()}"
+    tz_name, at = bucket
+    today = datetime.now(tz=pytz.timezone(tz_name)).date()
+    return f"{kind}:{period}:{tz_name}:{at.strftime('%H:%M')}:{today}"
+
+def enqueue_reminders(period, bucket, job_key):
+    """Queue the `period` reminder for every target and snapshot their counts, in one transaction."""
+    where, params = reminder_target_filter(period, bucket)
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            with conn.cursor(name=f"reminder_targets_{next(_cursor_ids)}") as targets:
+                targets.itersize = USER_BATCH_SIZE
+                targets.execute(f"SELECT chat_id, code, id FROM user_codes WHERE {where} ORDER BY chat_id", params)
+
+                def messages():
+                    # Non-numeric chats, the TEST user and participants at target are filtered in SQL.
+                    for chat_id_str, code, participant_id in targets:
+                        chat_id_int = parse_chat_id(chat_id_str)
+                        if chat_id_int is not None:
+                            yield reminder_message(period, chat_id_int, code, participant_id)
+
+                queued = enqueue_messages(cur, job_key, messages())
+            if queued:
+                # A re-run that queued nothing new must not move the baseline of the first run.
+                store_current_counts(cur, period, bucket)
+            conn.commit()
+    return queued
+
+async def send_reminders(context: ContextTypes.DEFAULT_TYPE, period, bucket=None):
+    label = bucket_label(period, bucket)
+    job_key = run_job_key("reminder", period, bucket)
+    try:
+        queued = await run_db(enqueue_reminders, period, bucket, job_key)
+        wake_outbox_dispatcher()
+        result = await wait_for_outbox_job(job_key)
     except Exception as e:
-        logger.error(f"Error in morning reminder: {e}")
-        await context.bot.send_message(chat_id=MODERATOR_ID, text=f"Error in morning reminder: {e}")
+        logger.error(f"Error in {label} reminder: {e}")
+        await context.bot.send_message(chat_id=MODERATOR_ID, text=f"Error in {label} reminder: {e}")
+        return
+    logger.info(f"{label} reminder done ({queued} queued): {result.summary()}")
+    if result.total:
+        await context.bot.send_message(
+            chat_id=MODERATOR_ID,
+            text=f"Reminder ({label}): {result.summary()}"
+        )
 
-async def evening_reminder(context: ContextTypes.DEFAULT_TYPE):
-    logger.info("evening_reminder job triggered.")
+def claim_followup_targets(cur, period, bucket=None):
+    """Mark and return (chat_id, code, id) of everyone whose `period` count hasn't moved since the snapshot.
+
+    Each snapshot row is claimed at most once, so a re-run never nudges the same person twice.
+    """
+    column = REMINDER_COUNT_COLUMN[period]
+    bucket_sql = ""
+    params = (period,)
+    if bucket is not None:
+        bucket_sql = f"AND u.timezone = %s AND u.{REMINDER_TIME_COLUMN[period]} = %s"
+        params += tuple(bucket)
+    cur.execute(f"""
+        UPDATE reminder_snapshots s
+        SET nudged_at = now()
+        FROM user_codes u
+        WHERE s.period = %s
+          AND s.nudged_at IS NULL
+          AND u.chat_id = s.chat_id
+          AND u.{column} = s.count
+          {bucket_sql}
+        RETURNING u.chat_id, u.code, u.id
+    """, params)
+    return cur.fetchall()
+
+def followup_message(period, chat_id_int, code, participant_id=None):
+    if period == "morning":
+        button = InlineKeyboardButton("Complete Morning Entry",
+                                      callback_data=participant_callback("morning_", participant_id, code))
+    else:
+        button = InlineKeyboardButton("Complete Evening Entry",
+                                      callback_data=participant_callback("evening_", participant_id, code))
+    return {
+        "chat_id": chat_id_int,
+        "text": (
+            f"Friendly nudge, {code}!\n"
+            f"We haven't received your {period} entry yet. Tap below when you're ready."
+        ),
+        "reply_markup": InlineKeyboardMarkup([[button]]),
+    }
+
+def enqueue_followups(period, bucket, job_key):
+    """Claim the participants who forgot and queue their nudges, in one transaction."""
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            rows = claim_followup_targets(cur, period, bucket)
+            messages = []
+            for chat_id_str, code, participant_id in rows:
+                chat_id_int = parse_chat_id(chat_id_str)
+                if chat_id_int is not None:
+                    messages.append(followup_message(period, chat_id_int, code, participant_id))
+            queued = enqueue_messages(cur, job_key, messages)
+            conn.commit()
+    return queued
+
+async def send_followups(context: ContextTypes.DEFAULT_TYPE, period, bucket=None):
+    label = bucket_label(period, bucket)
+    job_key = run_job_key("followup", period, bucket)
     try:
-        all_users = get_all_users()
-        for u in all_users:
-            chat_id_str = u["chat_id"]
-            code = u["code"]
-            # <<< ADDED: skip if chat_id not numeric >>>
+        queued = await run_db(enqueue_followups, period, bucket, job_key)
+        wake_outbox_dispatcher()
+        result = await wait_for_outbox_job(job_key)
+    except Exception as e:
+        logger.error(f"Error in {label} follow-up: {e}")
+        await context.bot.send_message(chat_id=MODERATOR_ID, text=f"Error in {label} follow-up: {e}")
+        return
+    logger.info(f"{label} follow-up done ({queued} queued): {result.summary()}")
+    if result.total:
+        await context.bot.send_message(
+            chat_id=MODERATOR_ID,
+            text=f"Follow-up nudges ({label}): {result.summary()}"
+        )
+
+#############################
+# Scheduling (per-timezone buckets)
+#############################
+
+# Participants are grouped by (timezone, reminder time). Each distinct bucket gets
+# one reminder job and one follow-up job, so the number of scheduler jobs grows with
+# the number of buckets, not the number of participants.
+
+def parse_bucket_time(at_str):
+    hour, minute = at_str.split(":")
+    return dt_time(int(hour), int(minute))
+
+async def reminder_job(context: ContextTypes.DEFAULT_TYPE, period, tz_name, at_str):
+    bucket = (tz_name, parse_bucket_time(at_str))
+    if not is_scheduler_leader():
+        logger.debug(f"Skipping reminder_job for {bucket_label(period, bucket)}: not the scheduler leader.")
+        return
+    logger.info(f"reminder_job triggered for {bucket_label(period, bucket)}.")
+    await send_reminders(context, period, bucket)
+
+async def followup_job(context: ContextTypes.DEFAULT_TYPE, period, tz_name, at_str):
+    bucket = (tz_name, parse_bucket_time(at_str))
+    if not is_scheduler_leader():
+        logger.debug(f"Skipping followup_job for {bucket_label(period, bucket)}: not the scheduler leader.")
+        return
+    logger.info(f"followup_job triggered for {bucket_label(period, bucket)}.")
+    await send_followups(context, period, bucket)
+
+def followup_time(hour, minute):
+    total = (hour * 60 + minute + FOLLOWUP_DELAY_MINUTES) % (24 * 60)
+    return divmod(total, 60)
+
+def round_reminder_time(at):
+    step = REMINDER_TIME_STEP_MINUTES
+    total = (at.hour * 60 + at.minute + step // 2) // step * step % (24 * 60)
+    return dt_time(*divmod(total, 60))
+
+_bucket_lock = threading.Lock()
+
+def refresh_reminder_buckets(application):
+    """Make the scheduler's reminder/follow-up jobs match the buckets currently in the DB."""
+    with _bucket_lock:
+        _refresh_reminder_buckets(application)
+
+def _refresh_reminder_buckets(application):
+    wanted = {}
+    for period in REMINDER_COUNT_COLUMN:
+        for tz_name, at in get_reminder_buckets(period):
             try:
-                chat_id_int = int(chat_id_str)
-            except ValueError:
-                logger.warning(f"Skipping non-numeric chat_id={chat_id_str}")
+                tz = pytz.timezone(tz_name)
+            except pytz.UnknownTimeZoneError:
+                logger.error(f"Unknown timezone {tz_name} in user_codes, skipping its bucket.")
                 continue
+            at_str = at.strftime("%H:%M")
+            f_hour, f_minute = followup_time(at.hour, at.minute)
+            wanted[f"reminder:{period}:{tz_name}:{at_str}"] = (
+                reminder_job, CronTrigger(hour=at.hour, minute=at.minute, timezone=tz), period, tz_name, at_str
+            )
+            wanted[f"followup:{period}:{tz_name}:{at_str}"] = (
+                followup_job, CronTrigger(hour=f_hour, minute=f_minute, timezone=tz), period, tz_name, at_str
+            )
 
-            if code == "TEST":
-                logger.info("Skipping real DB reminder for code=TEST (test user).")
-                continue
+    existing = {job.id for job in scheduler.get_jobs()
+                if job.id.startswith("reminder:") or job.id.startswith("followup:")}
+    for job_id in existing - wanted.keys():
+        scheduler.remove_job(job_id)
+    for job_id in wanted.keys() - existing:
+        func, trigger, period, tz_name, at_str = wanted[job_id]
+        scheduler.add_job(
+            func,
+            trigger,
+            args=[application, period, tz_name, at_str],
+            id=job_id,
+            replace_existing=True
+        )
+    logger.info(f"Reminder buckets refreshed: {len(wanted) // 2} bucket(s), "
+                f"{len(wanted.keys() - existing)} job(s) added, {len(existing - wanted.keys())} removed.")
 
-            keyboard = [
-                [InlineKeyboardButton("Complete Evening Entry", callback_data=f"evening_{code}")],
-                [InlineKeyboardButton("Contact Admin", callback_data=f"contactadmin_{code}")]
-            ]
-            markup = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_message(
-                chat_id=chat_id_int,
-                text=(
-                    f"Good evening!\n"
-                    f"You are {code}, correct?\n"
-                    "Tap below to fill your evening diary or contact admin."
-                ),
-                reply_markup=markup
-            )
-        store_current_counts("evening")
-    except Exception as e:
-        logger.error(f"Error in evening reminder: {e}")
-        await context.bot.send_message(chat_id=MODERATOR_ID, text=f"Error in evening reminder: {e}")
+async def purge_outbox_job():
+    if is_scheduler_leader():
+        await run_db(purge_outbox)
+        await run_db(purge_entry_dedup)
+
+async def diary_partitions_job():
+    if is_scheduler_leader():
+        await run_db(maintain_diary_partitions)
 
 def schedule_jobs(application):
-    logger.info("Scheduling morning & evening reminder jobs.")
+    logger.info("Scheduling bucketed reminder and follow-up jobs.")
     if not scheduler.running:
         scheduler.start()
+    refresh_reminder_buckets(application)
     scheduler.add_job(
-        morning_reminder,
-        CronTrigger(hour=8, minute=0, timezone=SINGAPORE_TZ),
+        refresh_reminder_buckets,
+        "interval",
+        minutes=BUCKET_REFRESH_MINUTES,
         args=[application],
-        id="morning_reminder",
+        id="refresh_reminder_buckets",
         replace_existing=True
     )
     scheduler.add_job(
-        evening_reminder,
-        CronTrigger(hour=18, minute=0, timezone=SINGAPORE_TZ),
-        args=[application],
-        id="evening_reminder",
+        purge_outbox_job,
+        CronTrigger(hour=3, minute=0, timezone=SINGAPORE_TZ),
+        id="purge_outbox",
+        replace_existing=True
+    )
+    scheduler.add_job(
+        diary_partitions_job,
+        CronTrigger(hour=3, minute=30, timezone=SINGAPORE_TZ),
+        id="diary_partitions",
         replace_existing=True
     )
 
@@ -460,29 +2645,23 @@ def schedule_jobs(application):
 
 async def reminder_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    data = query.data
-    logger.debug(f"reminder_button_handler triggered with data={data}")
+    logger.debug(f"reminder_button_handler triggered with data={query.data}")
     await query.answer()
+    # Set by CallbackRouter.dispatch: ("morning_" | "evening_" | "contactadmin_", code)
+    prefix, user_code = context.callback_prefix, context.callback_arg
 
-    if data.startswith("contactadmin_"):
-        parts = data.split("_", 1)
-        if len(parts) != 2:
-            await query.edit_message_text("Contact Admin: invalid data.")
-            return
-        user_code = parts[1]
-        context.user_data["p2a_user_code"] = user_code
-        context.user_data["p2a_typed_message"] = True
+    if prefix == "contactadmin_":
+        chat_states.set(query.message.chat_id, "p2a_message", user_code=user_code)
         await query.edit_message_text("Please type the message you want to send to the admin.")
         return
 
-    parts = data.split("_")
-    if len(parts) != 2:
+    if not user_code:
         await query.edit_message_text("Invalid data. Please contact support.")
         return
 
-    entry_type, user_code = parts
+    entry_type = prefix[:-1]
     chat_id = str(query.message.chat_id)
-    user = load_user(chat_id)
+    user = await load_user_async(chat_id)
     if not user:
         await query.edit_message_text("You’re not registered. Please use /start.")
         return
@@ -494,13 +2673,11 @@ async def reminder_button_handler(update: Update, context: ContextTypes.DEFAULT_
         if entry_type == "morning":
             form_link = MORNING_FORM
             friendly_text = "morning"
-            context.user_data["entry_type"] = "morning"
         else:
             form_link = EVENING_FORM
             friendly_text = "evening"
-            context.user_data["entry_type"] = "evening"
 
-        keyboard = [[InlineKeyboardButton("I’m Done! (TEST)", callback_data="done_entry")]]
+        keyboard = [[InlineKeyboardButton("I’m Done! (TEST)", callback_data=f"done_entry:{entry_type}")]]
         markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text(
             text=(
@@ -511,8 +2688,9 @@ async def reminder_button_handler(update: Update, context: ContextTypes.DEFAULT_
         )
         return
 
-    # Normal mismatch check
-    if user_code != user["code"]:
+    # Normal mismatch check: compact buttons name the participant by id, old ones by code
+    button_user = context.callback_user
+    if (button_user.id != user.id) if button_user is not None else (user_code != user.code):
         keyboard = [
             [InlineKeyboardButton("Update Code", callback_data="update_code")],
             [InlineKeyboardButton("Restart Diary", callback_data="restart_diary")]
@@ -529,13 +2707,12 @@ async def reminder_button_handler(update: Update, context: ContextTypes.DEFAULT_
     if entry_type == "morning":
         form_link = MORNING_FORM
         friendly_text = "morning"
-        context.user_data["entry_type"] = "morning"
     else:
         form_link = EVENING_FORM
         friendly_text = "evening"
-        context.user_data["entry_type"] = "evening"
 
-    keyboard = [[InlineKeyboardButton("I’m Done!", callback_data="done_entry")]]
+    # The period rides on the button, so each open form records its own entry type
+    keyboard = [[InlineKeyboardButton("I’m Done!", callback_data=f"done_entry:{entry_type}")]]
     markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(
         text=(
@@ -551,16 +2728,16 @@ async def code_mismatch_handler(update: Update, context: ContextTypes.DEFAULT_TY
     await query.answer()
     choice = query.data
     chat_id = str(query.message.chat_id)
-    user = load_user(chat_id)
+    user = await load_user_async(chat_id)
     if not user:
         await query.edit_message_text("You’re not registered. Please use /start.")
         return
 
     if choice == "update_code":
         await query.edit_message_text("Please type your new code in the chat.")
-        context.user_data["awaiting_new_code"] = True
+        chat_states.set(chat_id, "change_code")
     else:
-        reset_user(chat_id)
+        await reset_user_async(chat_id)
         await query.edit_message_text(
             "Your diary study has been restarted!\n"
             "All your morning/night counts are reset to 0.\n"
@@ -568,22 +2745,45 @@ async def code_mismatch_handler(update: Update, context: ContextTypes.DEFAULT_TY
         )
 
 async def done_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """"done_entry:<morning|evening>" records the entry; plain "done_entry" buttons predate the period suffix."""
     logger.debug(f"done_button_handler triggered with data={update.callback_query.data}")
     query = update.callback_query
-    await query.answer()
     chat_id = str(query.message.chat_id)
-    user = load_user(chat_id)
+    user = await load_user_async(chat_id)
     if not user:
+        await query.answer()
         await query.edit_message_text("You’re not registered. Please /start.")
         return
 
-    entry_type = context.user_data.get("entry_type", None)
+    entry_type = context.callback_arg or context.user_data.get("entry_type", None)
     if entry_type not in ["morning", "evening"]:
+        await query.answer()
         await query.edit_message_text("No entry type found. Please wait for next reminder.")
         return
 
+    # A form only counts on the participant's local day it was sent (its message
+    # date is the reminder's), and once per participant, period and day: double
+    # taps, the follow-up nudge and redelivered updates all share this key.
+    tz = pytz.timezone(user.timezone or DEFAULT_TIMEZONE)
+    form_day = query.message.date.astimezone(tz).date()
+    if form_day != datetime.now(tz).date():
+        await query.answer()
+        await query.edit_message_text("This form has expired. Please wait for the next reminder.")
+        return
+    dedup_key = f"{user.id}:{entry_type}:{form_day.isoformat()}"
+    if entry_dedup_cache.get(dedup_key):
+        await query.answer("This entry is already recorded.")
+        return
+    await query.answer()
+
     is_morning = (entry_type == "morning")
-    m_count, n_count, is_done = update_counts(chat_id, is_morning)
+    m_count, n_count, is_done, duplicate = await update_counts_async(chat_id, is_morning, query.id, dedup_key)
+    entry_dedup_cache.put(dedup_key, True)
+    if duplicate:
+        await query.edit_message_text(
+            f"This entry was already recorded. You have {m_count} morning and {n_count} evening entries."
+        )
+        return
     if is_done:
         await query.edit_message_text(
             text=(
@@ -618,11 +2818,21 @@ async def participant_to_admin_confirm_callback(update: Update, context: Context
             await query.edit_message_text("No codename found. Aborting.")
             return
         # send to admin
-        await context.bot.send_message(
-            chat_id=ADMIN_ID,
-            text=f"[{user_code}] says:\n{msg_text}\n\nUse /admin -> 'Private Message a Participant' to reply."
+        job_key = f"p2a:{uuid.uuid4().hex[:12]}"
+        await send_via_outbox(
+            job_key,
+            {
+                "chat_id": ADMIN_ID,
+                "text": f"[{user_code}] says:\n{msg_text}\n\nUse /admin -> 'Private Message a Participant' to reply."
+            }
+        )
+        await query.edit_message_text("Your message is on its way to the admin.")
+        context.application.create_task(
+            report_delivery(context.bot, job_key, query.message,
+                            "Your message has been sent to the admin.",
+                            "Sorry, your message could not be delivered to the admin. Please try again later."),
+            update=None
         )
-        await query.edit_message_text("Your message has been sent to the admin.")
         context.user_data["p2a_msg_text"] = ""
         context.user_data["p2a_user_code"] = ""
     else:
@@ -649,7 +2859,9 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("Broadcast Message", callback_data="adm_broadcast")],
         [InlineKeyboardButton("Private Message a Participant", callback_data="adm_private")],
         [InlineKeyboardButton("Test All Bot Functions", callback_data="adm_testall")],
-        [InlineKeyboardButton("Check Next Reminders", callback_data="adm_next_reminders")]
+        [InlineKeyboardButton("Check Next Reminders", callback_data="adm_next_reminders")],
+        [InlineKeyboardButton("Bot Stats", callback_data="adm_stats")],
+        [InlineKeyboardButton("Export Data", callback_data="adm_export")]
     ]
     markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text("Hello Admin! What do you need?", reply_markup=markup)
@@ -671,11 +2883,11 @@ async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     elif choice == "adm_reset_change":
         await show_inline_all_codes(query, prefix="adm_resetchange_")
     elif choice == "adm_forgot":
-        text = check_forgot_entries()
+        text = await run_db(check_forgot_entries)
         await query.edit_message_text(text or "No missing entries found.")
     elif choice == "adm_broadcast":
         await query.edit_message_text("Please type the message to broadcast to all participants.")
-        context.user_data["adm_broadcast"] = True
+        chat_states.set(query.message.chat_id, "adm_broadcast")
     elif choice == "adm_private":
         await show_inline_all_codes(query, prefix="adm_private_")
     elif choice == "adm_testall":
@@ -686,65 +2898,192 @@ async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     elif choice == "adm_next_reminders":
         text = get_next_reminders_info()
         await query.edit_message_text(text)
+    elif choice == "adm_stats":
+        await query.edit_message_text(await get_bot_stats_text())
+    elif choice == "adm_export":
+        await show_export_menu(query)
+
+def format_progress_summary(summary):
+    total = summary["total"]
+    if not total:
+        return "No users found."
+    full = 2 * TARGET_COUNT
+    labels = ["0-24%", "25-49%", "50-74%", "75-99%", "100%"]
+    lines = [
+        f"Participants: {total}, completed: {summary['completed']} ({100 * summary['completed'] / total:.0f}%)",
+        f"Entries: {summary['morning']} morning, {summary['evening']} evening "
+        f"(avg {summary['avg_entries']:.1f}/{full})",
+        "",
+        "Completion:",
+    ]
+    for bucket, label in enumerate(labels, start=1):
+        n = summary["histogram"].get(bucket, 0)
+        bar = "#" * round(20 * n / total)
+        lines.append(f"{label:>7} {n:>5} {bar}")
+    if summary["behind"]:
+        lines += ["", f"Behind: {summary['behind_total']} participant(s) more than {PROGRESS_BEHIND_MARGIN} "
+                      f"entries under the average. Furthest behind:"]
+        lines += [f"{code}: M {m}/{TARGET_COUNT}, E {e}/{TARGET_COUNT}" for code, m, e in summary["behind"]]
+    return "\n".join(lines)
+
+def progress_line(code, morning_count, night_count):
+    return (f"Code: {code}, M:{morning_count}/{TARGET_COUNT} (left {max(0, TARGET_COUNT - morning_count)}), "
+            f"E:{night_count}/{TARGET_COUNT} (left {max(0, TARGET_COUNT - night_count)})")
 
 async def show_all_users_progress(query):
     logger.debug("show_all_users_progress called.")
-    users = get_all_users()
-    if not users:
-        await query.edit_message_text("No users found.")
+    summary = await run_db(get_progress_summary)
+    markup = None
+    if summary["total"]:
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton("Per-participant details", callback_data="adm_prog:n:")]])
+    await query.edit_message_text(format_progress_summary(summary), reply_markup=markup)
+
+async def show_progress_page(query, after=None, before=None):
+    """One detail page: up to PROGRESS_PAGE_SIZE lines, trimmed to fit a single message.
+
+    `after`/`before` are participant ids; page buttons carry them in base 36 so
+    callback_data stays short whatever the codes look like.
+    """
+    rows, has_prev, has_next = await run_db(
+        get_code_page_rows, ("code", "morning_count", "night_count", "id"), "", after, before, PROGRESS_PAGE_SIZE
+    )
+    lines = [progress_line(*row[:3]) for row in rows]
+    # Trim the side away from the anchor so paging back and forth stays consistent.
+    while len("\n".join(lines)) > MAX_MESSAGE_CHARS:
+        if before is not None:
+            lines.pop(0)
+            rows.pop(0)
+            has_prev = True
+        else:
+            lines.pop()
+            rows.pop()
+            has_next = True
+    nav = []
+    if rows and has_prev:
+        nav.append(InlineKeyboardButton("« Prev", callback_data=f"adm_prog:p:{to_base36(rows[0][3])}"))
+    if rows and has_next:
+        nav.append(InlineKeyboardButton("Next »", callback_data=f"adm_prog:n:{to_base36(rows[-1][3])}"))
+    buttons = [nav] if nav else []
+    buttons.append([InlineKeyboardButton("Summary", callback_data="adm_check_progress")])
+    await query.edit_message_text("\n".join(lines) or "No users found.",
+                                  reply_markup=InlineKeyboardMarkup(buttons))
+
+async def admin_progress_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """"adm_prog:<n|p>:<anchor participant id in base 36>" pages through the progress details."""
+    query = update.callback_query
+    await query.answer()
+    if query.message.chat_id != ADMIN_ID:
+        await query.edit_message_text("Not authorized.")
         return
-    lines = []
-    for u in users:
-        m_count = u["morning_count"]
-        n_count = u["night_count"]
-        remain_m = max(0, TARGET_COUNT - m_count)
-        remain_n = max(0, TARGET_COUNT - n_count)
-        lines.append(
-            f"Code: {u['code']}, M:{m_count}/{TARGET_COUNT} "
-            f"(left {remain_m}), E:{n_count}/{TARGET_COUNT} "
-            f"(left {remain_n})"
-        )
-    await query.edit_message_text("\n".join(lines) or "No data.")
-
-async def show_inline_all_codes(query, prefix):
-    logger.debug(f"show_inline_all_codes called with prefix={prefix}")
-    users = get_all_users()
-    if not users:
-        await query.edit_message_text("No users found.")
+    try:
+        _, direction, anchor = query.data.split(":", 2)
+        anchor = int(anchor, 36) if anchor else None
+    except ValueError:
+        await query.edit_message_text("This page is no longer available. Use /admin to start again.")
         return
+    if anchor is None:
+        await show_progress_page(query)
+    elif direction == "p":
+        await show_progress_page(query, before=anchor)
+    else:
+        await show_progress_page(query, after=anchor)
 
-    buttons = []
-    row = []
-    for u in users:
-        code = u["code"]
-        callback_data = f"{prefix}{code}"
-        row.append(InlineKeyboardButton(code, callback_data=callback_data))
-        if len(row) == 3:
-            buttons.append(row)
-            row = []
-    if row:
-        buttons.append(row)
+# Picker action -> callback prefix of the code buttons it shows
+CODE_PICKER_ACTIONS = {
+    "find": "adm_find_",
+    "resetchange": "adm_resetchange_",
+    "private": "adm_private_",
+}
 
-    markup = InlineKeyboardMarkup(buttons)
-    await query.edit_message_text("Please select a codename:", reply_markup=markup)
+CODE_SEARCHES_KEPT = 10  # recent prefix searches whose result pages can still be paged
+
+def code_search_token(search):
+    return to_base36(zlib.crc32(search.encode()))
+
+def remember_code_search(user_data, search):
+    """Keep `search` in user_data under its token, so its pages' buttons need not carry the text."""
+    searches = user_data.setdefault("adm_code_searches", {})
+    searches.pop(code_search_token(search), None)
+    searches[code_search_token(search)] = search
+    while len(searches) > CODE_SEARCHES_KEPT:
+        del searches[next(iter(searches))]
+
+async def build_code_picker(action, search="", after=None, before=None):
+    """Text and keyboard for one page of the codename picker; `after`/`before` are participant ids.
+
+    Page buttons carry "adm_pg:<action>:<n|p>:<scope>:<anchor id in base 36>", where
+    scope is "a" for all codes or "s<token>" for a prefix search remembered by
+    remember_code_search, so callback_data stays well under Telegram's 64 bytes
+    and an old button keeps paging within its own search.
+    """
+    rows, has_prev, has_next = await run_db(
+        get_code_page_rows, ("code", "id"), search, after, before
+    )
+    codes = [code for code, _ in rows]
+    scope = f"s{code_search_token(search)}" if search else "a"
+    prefix = CODE_PICKER_ACTIONS[action]
+    buttons = [
+        [InlineKeyboardButton(code, callback_data=participant_callback(prefix, pid, code)) for code, pid in rows[i:i + 3]]
+        for i in range(0, len(rows), 3)
+    ]
+    nav = []
+    if rows and has_prev:
+        nav.append(InlineKeyboardButton("« Prev", callback_data=f"adm_pg:{action}:p:{scope}:{to_base36(rows[0][1])}"))
+    if rows and has_next:
+        nav.append(InlineKeyboardButton("Next »", callback_data=f"adm_pg:{action}:n:{scope}:{to_base36(rows[-1][1])}"))
+    if nav:
+        buttons.append(nav)
+    buttons.append([InlineKeyboardButton("Search by prefix", callback_data=f"adm_pgsearch:{action}")])
+    if search:
+        buttons[-1].append(InlineKeyboardButton("Show all", callback_data=f"adm_pg:{action}:n:a:"))
+        text = f"Codes starting with '{search}':" if codes else f"No codes start with '{search}'."
+    else:
+        text = "Please select a codename:" if codes else "No users found."
+    return text, InlineKeyboardMarkup(buttons)
 
-def check_forgot_entries():
-    logger.debug("check_forgot_entries called.")
-    missing = []
-    all_users = get_all_users()
-    old_morning = last_reminder_counts.get("morning", {})
-    for u in all_users:
-        if u["chat_id"] in old_morning:
-            old_val = old_morning[u["chat_id"]]
-            if (u["morning_count"] or 0) == (old_val or 0):
-                missing.append(f"{u['code']} forgot morning entry")
-    old_evening = last_reminder_counts.get("evening", {})
-    for u in all_users:
-        if u["chat_id"] in old_evening:
-            old_val = old_evening[u["chat_id"]]
-            if (u["night_count"] or 0) == (old_val or 0):
-                missing.append(f"{u['code']} forgot evening entry")
-    return "\n".join(missing)
+async def show_inline_all_codes(query, prefix):
+    logger.debug(f"show_inline_all_codes called with prefix={prefix}")
+    action = next(a for a, p in CODE_PICKER_ACTIONS.items() if p == prefix)
+    text, markup = await build_code_picker(action)
+    await query.edit_message_text(text, reply_markup=markup)
+
+async def admin_code_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Next/prev pages ("adm_pg:...") and the prefix-search prompt ("adm_pgsearch:<action>")."""
+    query = update.callback_query
+    await query.answer()
+    if query.message.chat_id != ADMIN_ID:
+        await query.edit_message_text("Not authorized.")
+        return
+    if query.data.startswith("adm_pgsearch:"):
+        action = query.data.split(":", 1)[1]
+        if action not in CODE_PICKER_ACTIONS:
+            await query.edit_message_text("This button is no longer supported. Use /admin to start again.")
+            return
+        chat_states.set(query.message.chat_id, "adm_code_search", action=action)
+        await query.edit_message_text("Type the first letters of the code you are looking for.")
+        return
+    try:
+        _, action, direction, scope, anchor = query.data.split(":", 4)
+        anchor = int(anchor, 36) if anchor else None
+    except ValueError:
+        await query.edit_message_text("This page is no longer available. Use /admin to start again.")
+        return
+    if action not in CODE_PICKER_ACTIONS:
+        await query.edit_message_text("This button is no longer supported. Use /admin to start again.")
+        return
+    search = ""
+    if scope != "a":
+        search = context.user_data.get("adm_code_searches", {}).get(scope[1:])
+        if search is None:
+            await query.edit_message_text("This search has expired. Use /admin to search again.")
+            return
+    if anchor is None:
+        text, markup = await build_code_picker(action, search)
+    elif direction == "p":
+        text, markup = await build_code_picker(action, search, before=anchor)
+    else:
+        text, markup = await build_code_picker(action, search, after=anchor)
+    await query.edit_message_text(text, reply_markup=markup)
 
 #############################
 # Admin: inline code selection
@@ -755,8 +3094,9 @@ async def admin_code_inline_handler(update: Update, context: ContextTypes.DEFAUL
     logger.debug(f"admin_code_inline_handler triggered with data={data}")
     await query.answer()
 
-    parts = data.split("_", 2)
-    if len(parts) < 3:
+    # Set by CallbackRouter.dispatch, e.g. ("adm_find_", "BCR25"); "adm_" is the catch-all.
+    prefix, codename = context.callback_prefix, context.callback_arg
+    if prefix == "adm_" or not codename:
         # fallback
         keyboard = [[InlineKeyboardButton("Contact Admin", url="t.me/...")]]
         markup = InlineKeyboardMarkup(keyboard)
@@ -766,72 +3106,52 @@ async def admin_code_inline_handler(update: Update, context: ContextTypes.DEFAUL
         )
         return
 
-    prefix = parts[0]  # "adm"
-    subprefix = parts[1]  # "find", "reset_change", "private", etc.
-    codename = parts[2]
+    subprefix = prefix[len("adm_"):-1]  # "find", "resetchange" or "private"
 
-    if prefix == "adm":
-        # <<< ADDED: skip if subprefix in ["reset","change"] because that's handled by admin_reset_change_callback >>>
-        if subprefix in ["reset", "change"]:
-            logger.info(f"Skipping subprefix={subprefix}, handled by admin_reset_change_callback.")
-            return
+    # Old code-carrying buttons can only be resolved by code (the first match if codes repeat).
+    user = context.callback_user or await load_user_by_code_async(codename)
 
-        if subprefix == "find":
-            user = load_user_by_code(codename)
-            if user:
-                m_count = user["morning_count"]
-                n_count = user["night_count"]
-                remain_m = max(0, TARGET_COUNT - m_count)
-                remain_n = max(0, TARGET_COUNT - n_count)
-                msg = (
-                    f"Code: {codename}\n"
-                    f"Morning: {m_count} (left {remain_m})\n"
-                    f"Evening: {n_count} (left {remain_n})\n"
-                    f"ChatID: {user['chat_id']}\n"
-                    f"Color/Animal/Sport/Age: {user['color']}, {user['animal']}, {user['sport']}, {user['age']}"
-                )
-                await query.edit_message_text(msg)
-            else:
-                await query.edit_message_text(f"No user found with code {codename}.")
-
-        elif subprefix == "resetchange":
-            user = load_user_by_code(codename)
-            if not user:
-                await query.edit_message_text(f"No user found with code {codename}.")
-                return
-            kb = [
-                [InlineKeyboardButton("Reset counts", callback_data=f"adm_reset_{codename}")],
-                [InlineKeyboardButton("Change code", callback_data=f"adm_change_{codename}")]
-            ]
-            markup = InlineKeyboardMarkup(kb)
-            await query.edit_message_text(
-                f"User found: {codename}.\nDo you want to reset counts or change code?",
-                reply_markup=markup
+    if subprefix == "find":
+        if user:
+            msg = (
+                f"Code: {codename}\n"
+                f"Morning: {user.morning_count} (left {user.remaining_morning})\n"
+                f"Evening: {user.night_count} (left {user.remaining_evening})\n"
+                f"ChatID: {user.chat_id}\n"
+                f"Color/Animal/Sport/Age: {user.color}, {user.animal}, {user.sport}, {user.age}"
             )
+            await query.edit_message_text(msg)
+        else:
+            await query.edit_message_text(f"No user found with code {codename}.")
 
-        elif subprefix == "private":
-            user = load_user_by_code(codename)
-            if not user:
-                await query.edit_message_text(f"No user found with code {codename}.")
-                return
-            context.user_data["adm_private_chatid"] = user["chat_id"]
-            context.user_data["adm_private_msg"] = True
-            await query.edit_message_text(
-                f"Please type the message you want to send to {codename}."
-            )
+    elif subprefix == "resetchange":
+        if not user:
+            await query.edit_message_text(f"No user found with code {codename}.")
+            return
+        kb = [
+            [InlineKeyboardButton("Reset counts", callback_data=participant_callback("adm_reset_", user.id, codename))],
+            [InlineKeyboardButton("Change code", callback_data=participant_callback("adm_change_", user.id, codename))]
+        ]
+        markup = InlineKeyboardMarkup(kb)
+        await query.edit_message_text(
+            f"User found: {codename}.\nDo you want to reset counts or change code?",
+            reply_markup=markup
+        )
+
+    elif subprefix == "private":
+        if not user:
+            await query.edit_message_text(f"No user found with code {codename}.")
+            return
+        chat_states.set(query.message.chat_id, "adm_private", target_chat_id=user.chat_id)
+        await query.edit_message_text(
+            f"Please type the message you want to send to {codename}."
+        )
 
-        else:
-            keyboard = [[InlineKeyboardButton("Contact Admin", url="t.me/...")]]
-            markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                f"I received your button click but I don’t know how to handle subprefix '{subprefix}'.",
-                reply_markup=markup
-            )
     else:
         keyboard = [[InlineKeyboardButton("Contact Admin", url="t.me/...")]]
         markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text(
-            f"I received your button click but prefix '{prefix}' is not recognized.",
+            f"I received your button click but I don’t know how to handle subprefix '{subprefix}'.",
             reply_markup=markup
         )
 
@@ -843,8 +3163,9 @@ async def admin_reset_change_callback(update: Update, context: ContextTypes.DEFA
     data = query.data
     logger.debug(f"admin_reset_change_callback triggered with data={data}")
     await query.answer()
-    parts = data.split("_", 2)
-    if len(parts) != 3:
+    # Set by CallbackRouter.dispatch: ("adm_reset_" | "adm_change_", code)
+    prefix, codename = context.callback_prefix, context.callback_arg
+    if not codename:
         keyboard = [[InlineKeyboardButton("Contact Admin", url="t.me/...")]]
         markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text(
@@ -853,24 +3174,21 @@ async def admin_reset_change_callback(update: Update, context: ContextTypes.DEFA
         )
         return
 
-    action = parts[1]
-    codename = parts[2]
+    action = prefix[len("adm_"):-1]
+    user = context.callback_user or await load_user_by_code_async(codename)
 
     if action == "reset":
-        user = load_user_by_code(codename)
         if not user:
             await query.edit_message_text("User not found.")
             return
-        reset_user(user["chat_id"])
+        await reset_user_async(user.chat_id)
         await query.edit_message_text(f"User with code {codename} has been reset to 0 morning/evening counts.")
     elif action == "change":
-        user = load_user_by_code(codename)
         if not user:
             await query.edit_message_text("User not found.")
             return
-        context.user_data["adm_change_user"] = user["chat_id"]
+        chat_states.set(query.message.chat_id, "adm_change_code", target_chat_id=user.chat_id)
         await query.edit_message_text("Please type the new code you want to assign.")
-        context.user_data["adm_changing_code"] = True
     else:
         keyboard = [[InlineKeyboardButton("Contact Admin", url="t.me/...")]]
         markup = InlineKeyboardMarkup(keyboard)
@@ -883,54 +3201,221 @@ async def admin_reset_change_callback(update: Update, context: ContextTypes.DEFA
 # Admin: Broadcasting & Private
 #############################
 
-async def broadcast_to_all(message: str, context: ContextTypes.DEFAULT_TYPE):
+def broadcast_job_key(broadcast_id):
+    return f"broadcast:{broadcast_id}"
+
+def broadcast_progress_text(broadcast_id, stats, elapsed):
+    handled = stats.sent + stats.failed
+    rate = handled / elapsed if elapsed > 0 else 0.0
+    if stats.done:
+        state = "cancelled" if stats.cancelled else "finished"
+    else:
+        state = "in progress"
+    lines = [
+        f"Broadcast {broadcast_id} {state}",
+        f"Sent: {stats.sent}, failed: {stats.failed}, remaining: {stats.pending + stats.sending}",
+    ]
+    if stats.cancelled:
+        lines.append(f"Cancelled: {stats.cancelled}")
+    lines.append(f"{handled}/{stats.total} in {elapsed:.0f}s ({rate:.1f} msg/s)")
+    return "\n".join(lines)
+
+def broadcast_cancel_markup(broadcast_id):
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("Cancel broadcast", callback_data=f"adm_bcancel_{broadcast_id}")
+    ]])
+
+async def broadcast_to_all(message: str, context: ContextTypes.DEFAULT_TYPE, progress_message):
+    """Queue `message` for every participant and start tracking it in `progress_message`.
+
+    Returns the broadcast ID once the rows are queued; delivery and the progress
+    updates carry on in a background task.
+    """
     logger.info(f"Broadcasting message to all participants: {message}")
-    users = get_all_users()
-    for u in users:
-        chat_id_str = u["chat_id"]
-        try:
-            chat_id_int = int(chat_id_str)
-        except ValueError:
-            logger.warning(f"Skipping non-numeric chat_id={chat_id_str}")
-            continue
-        try:
-            await context.bot.send_message(chat_id=chat_id_int, text=message)
-        except Exception as e:
-            logger.error(f"Failed to broadcast to {chat_id_str}: {e}")
+    broadcast_id = uuid.uuid4().hex[:12]
+    queued = await run_db(enqueue_broadcast, broadcast_job_key(broadcast_id), message)
+    wake_outbox_dispatcher()
+    context.application.create_task(
+        track_broadcast(context.bot, broadcast_id, progress_message.chat_id, progress_message.message_id),
+        update=None
+    )
+    return broadcast_id, queued
+
+async def track_broadcast(bot, broadcast_id, chat_id, message_id):
+    """Edit the admin's progress message until the broadcast is sent, failed or cancelled."""
+    job_key = broadcast_job_key(broadcast_id)
+    started = time.monotonic()
+    last_text = None
+    while True:
+        stats = await run_db(get_outbox_job_stats, job_key)
+        text = broadcast_progress_text(broadcast_id, stats, time.monotonic() - started)
+        markup = None if stats.done else broadcast_cancel_markup(broadcast_id)
+        if text != last_text:
+            try:
+                await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, reply_markup=markup)
+                last_text = text
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                logger.warning(f"Could not update progress of broadcast {broadcast_id}: {e}")
+        if stats.done:
+            logger.info(f"Broadcast {broadcast_id} done: {stats.summary()}")
+            return stats
+        await asyncio.sleep(BROADCAST_PROGRESS_SECONDS)
 
 async def private_message_user(chat_id: str, message: str, context: ContextTypes.DEFAULT_TYPE):
+    """Queue a private message; returns its outbox job key, or None if `chat_id` cannot be messaged."""
     logger.info(f"Private messaging chat_id={chat_id} with message={message}")
     try:
         chat_id_int = int(chat_id)
     except ValueError:
         logger.error(f"Cannot private-message non-numeric chat_id={chat_id}")
-        return
-    try:
-        await context.bot.send_message(chat_id=chat_id_int, text=message)
-    except Exception as e:
-        logger.error(f"Failed to private-message {chat_id}: {e}")
+        return None
+    job_key = f"private:{uuid.uuid4().hex[:12]}"
+    await send_via_outbox(job_key, {"chat_id": chat_id_int, "text": message})
+    return job_key
 
 #############################
 # Admin: Checking Who Forgot
 #############################
 
 def check_forgot_entries():
+    """List participants whose count has not moved since their last reminder snapshot."""
     logger.debug("check_forgot_entries called.")
-    missing = []
-    all_users = get_all_users()
-    old_morning = last_reminder_counts.get("morning", {})
-    for u in all_users:
-        if u["chat_id"] in old_morning:
-            old_val = old_morning[u["chat_id"]]
-            if (u["morning_count"] or 0) == (old_val or 0):
-                missing.append(f"{u['code']} forgot morning entry")
-    old_evening = last_reminder_counts.get("evening", {})
-    for u in all_users:
-        if u["chat_id"] in old_evening:
-            old_val = old_evening[u["chat_id"]]
-            if (u["night_count"] or 0) == (old_val or 0):
-                missing.append(f"{u['code']} forgot evening entry")
-    return "\n".join(missing)
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT u.code, s.period
+                FROM reminder_snapshots s
+                JOIN user_codes u ON u.chat_id = s.chat_id
+                WHERE (s.period = 'morning' AND u.morning_count = s.count)
+                   OR (s.period = 'evening' AND u.night_count = s.count)
+                ORDER BY s.period = 'evening', u.code
+            """)
+            rows = cur.fetchall()
+    return "\n".join(f"{code} forgot {period} entry" for code, period in rows)
+
+#############################
+# Admin: Data Export
+#############################
+
+# Export name -> query. Each is streamed from a server-side cursor, ordered so files are reproducible.
+EXPORTS = {
+    "participants": """
+        SELECT chat_id, code, color, animal, sport, age, morning_count, night_count,
+               timezone, morning_time, evening_time
+        FROM user_codes ORDER BY chat_id
+    """,
+    "snapshots": """
+        SELECT period, chat_id, count, taken_at, nudged_at
+        FROM reminder_snapshots ORDER BY period, chat_id
+    """,
+    "entries": """
+        SELECT id, chat_id, entry_type, created_at, callback_id
+        FROM diary_entries ORDER BY created_at, id
+    """,
+}
+
+# Postgres type OID -> Arrow type, for the column types used in EXPORTS
+ARROW_TYPES = {
+    16: "bool_", 20: "int64", 21: "int16", 23: "int32", 25: "string", 1043: "string",
+    1082: "date32", 1114: "timestamp", 1184: "timestamptz", 1083: "time",
+}
+
+def arrow_schema(description):
+    fields = []
+    for column in description:
+        name = ARROW_TYPES.get(column.type_code, "string")
+        if name == "timestamp":
+            arrow_type = pa.timestamp("us")
+        elif name == "timestamptz":
+            arrow_type = pa.timestamp("us", tz="UTC")
+        elif name == "time":
+            arrow_type = pa.time64("us")
+        else:
+            arrow_type = getattr(pa, name)()
+        fields.append(pa.field(column.name, arrow_type))
+    return pa.schema(fields)
+
+def export_to_file(name, fmt, path, batch_size=EXPORT_BATCH_SIZE):
+    """Stream export `name` into `path` as "csv" or "parquet", one batch at a time. Returns the row count."""
+    query = EXPORTS[name]
+    rows_written = 0
+    with get_connection() as conn:
+        if fmt == "csv":
+            # COPY streams straight from the server into the file.
+            with conn.cursor() as cur, open(path, "w", newline="", encoding="utf-8") as f:
+                cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", f)
+                rows_written = cur.rowcount
+            return rows_written
+        with conn.cursor(name=f"export_{next(_cursor_ids)}") as cur:
+            cur.itersize = batch_size
+            cur.execute(query)
+            rows = cur.fetchmany(batch_size)
+            schema = arrow_schema(cur.description)
+            with pq.ParquetWriter(path, schema) as writer:
+                while rows:
+                    columns = list(zip(*rows))
+                    writer.write_table(pa.Table.from_arrays(
+                        [pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema
+                    ))
+                    rows_written += len(rows)
+                    rows = cur.fetchmany(batch_size)
+            if not rows_written:
+                # Still write a valid, empty file with the right columns.
+                pq.write_table(schema.empty_table(), path)
+    return rows_written
+
+async def show_export_menu(query):
+    buttons = []
+    for name in EXPORTS:
+        buttons.append([
+            InlineKeyboardButton(f"{name.capitalize()} CSV", callback_data=f"adm_export:{name}:csv"),
+            InlineKeyboardButton(f"{name.capitalize()} Parquet", callback_data=f"adm_export:{name}:parquet"),
+        ])
+    await query.edit_message_text("What should I export?", reply_markup=InlineKeyboardMarkup(buttons))
+
+async def admin_export_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """"adm_export:<name>:<csv|parquet>": write the export to a temp file and send it as a document."""
+    query = update.callback_query
+    await query.answer()
+    if query.message.chat_id != ADMIN_ID:
+        await query.edit_message_text("Not authorized.")
+        return
+    _, name, fmt = query.data.split(":", 2)
+    if name not in EXPORTS or fmt not in ("csv", "parquet"):
+        await query.edit_message_text("Unknown export.")
+        return
+    if fmt == "parquet" and pa is None:
+        await query.edit_message_text("Parquet export needs pyarrow (pip install pyarrow). CSV is always available.")
+        return
+
+    await query.edit_message_text(f"Exporting {name} as {fmt}...")
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        start = time.perf_counter()
+        rows = await run_db(export_to_file, name, fmt, path)
+        export_seconds = time.perf_counter() - start
+        size_kb = os.path.getsize(path) / 1024
+        filename = f"{name}-{datetime.now(SINGAPORE_TZ).strftime('%Y%m%d-%H%M')}.{fmt}"
+        start = time.perf_counter()
+        with open(path, "rb") as f:
+            await context.bot.send_document(
+                chat_id=ADMIN_ID, document=f, filename=filename, write_timeout=120,
+                caption=f"{rows} rows, {size_kb:.0f} KB"
+            )
+        upload_seconds = time.perf_counter() - start
+        logger.info(f"Exported {name} ({rows} rows, {size_kb:.0f} KB) as {fmt} in {export_seconds:.2f}s.")
+        await query.edit_message_text(
+            f"Exported {rows} {name} rows as {fmt} ({size_kb:.0f} KB).\n"
+            f"Query + write: {export_seconds:.2f}s, upload: {upload_seconds:.2f}s."
+        )
+    except Exception as e:
+        logger.error(f"Export of {name} as {fmt} failed: {e}")
+        await query.edit_message_text(f"Export failed: {e}")
+    finally:
+        os.remove(path)
 
 #############################
 # Test Morning/Evening Reminders
@@ -964,35 +3449,34 @@ async def test_evening_reminder_for_admin(context: ContextTypes.DEFAULT_TYPE):
 
 def get_next_reminders_info():
     logger.debug("get_next_reminders_info called.")
-    morning_job = scheduler.get_job("morning_reminder")
-    evening_job = scheduler.get_job("evening_reminder")
-    if not morning_job or not evening_job:
-        return "No scheduled jobs found."
-
     now = datetime.now(tz=SINGAPORE_TZ)
-    nm = morning_job.next_run_time
-    ne = evening_job.next_run_time
-
-    dm = (nm - now).total_seconds()
-    de = (ne - now).total_seconds()
-
-    if dm < 0:
-        text_m = "Morning reminder is due soon or triggered!"
-    else:
-        hrs_m, rem_m = divmod(dm, 3600)
-        mins_m, _ = divmod(rem_m, 60)
-        text_m = (f"Next Morning Reminder in {int(hrs_m)}h {int(mins_m)}m. "
-                  f"({nm.astimezone(SINGAPORE_TZ).strftime('%Y-%m-%d %H:%M %Z')})")
-
-    if de < 0:
-        text_e = "Evening reminder is due soon or triggered!"
-    else:
-        hrs_e, rem_e = divmod(de, 3600)
-        mins_e, _ = divmod(rem_e, 60)
-        text_e = (f"Next Evening Reminder in {int(hrs_e)}h {int(mins_e)}m. "
-                  f"({ne.astimezone(SINGAPORE_TZ).strftime('%Y-%m-%d %H:%M %Z')})")
-
-    return text_m + "\n" + text_e
+    lines = []
+    for period in REMINDER_COUNT_COLUMN:
+        jobs = [job for job in scheduler.get_jobs()
+                if job.id.startswith(f"reminder:{period}:") and job.next_run_time]
+        if not jobs:
+            lines.append(f"No {period} reminders scheduled.")
+            continue
+        job = min(jobs, key=lambda j: j.next_run_time)
+        nxt = job.next_run_time
+        delta = (nxt - now).total_seconds()
+        _, _, tz_name, at_str = job.id.split(":", 3)
+        if delta < 0:
+            lines.append(f"{period.capitalize()} reminder is due soon or triggered!")
+        else:
+            hrs, rem = divmod(delta, 3600)
+            mins, _ = divmod(rem, 60)
+            lines.append(f"Next {period.capitalize()} Reminder in {int(hrs)}h {int(mins)}m "
+                         f"({at_str} {tz_name}, {nxt.astimezone(SINGAPORE_TZ).strftime('%Y-%m-%d %H:%M %Z')}). "
+                         f"{len(jobs)} {period} bucket(s) scheduled.")
+    return "\n".join(lines)
+
+async def get_bot_stats_text():
+    logger.debug("get_bot_stats_text called.")
+    # chat_states and the persistence buffers belong to the event loop, so they are
+    # read here; only the worker stats query goes to the executor.
+    in_memory = get_pool_stats_text() + "\n\n" + get_cache_stats_text() + "\n\n" + bot_persistence.stats_text()
+    return in_memory + "\n\n" + await run_db(get_worker_stats_text)
 
 async def admin_broadcast_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -1001,8 +3485,9 @@ async def admin_broadcast_confirm_callback(update: Update, context: ContextTypes
     if choice == "adm_broadcast_confirm_yes":
         text = context.user_data.get("adm_broadcast_text", "")
         if text:
-            await broadcast_to_all(text, context)
-            await query.edit_message_text("Broadcast sent to all participants.")
+            await query.edit_message_text("Queuing broadcast...")
+            broadcast_id, queued = await broadcast_to_all(text, context, query.message)
+            logger.info(f"Broadcast {broadcast_id} started with {queued} message(s).")
         else:
             await query.edit_message_text("No broadcast text found. Nothing sent.")
         context.user_data["adm_broadcast_text"] = ""
@@ -1011,6 +3496,16 @@ async def admin_broadcast_confirm_callback(update: Update, context: ContextTypes
         await query.edit_message_text("Broadcast canceled.")
         context.user_data["adm_broadcast_text"] = ""
 
+async def admin_broadcast_cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """"adm_bcancel_<id>": drop the broadcast's unsent messages; the tracker shows the final tally."""
+    query = update.callback_query
+    if query.message.chat_id != ADMIN_ID:
+        await query.answer("Not authorized.")
+        return
+    broadcast_id = query.data[len("adm_bcancel_"):]
+    cancelled = await run_db(cancel_outbox_job, broadcast_job_key(broadcast_id))
+    await query.answer(f"Cancelled {cancelled} pending message(s).")
+
 async def admin_private_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Called when admin chooses Yes/No to confirm a private message to a participant."""
     query = update.callback_query
@@ -1020,8 +3515,17 @@ async def admin_private_confirm_callback(update: Update, context: ContextTypes.D
         p_chatid = context.user_data.get("adm_private_chatid", None)
         msg = context.user_data.get("adm_private_text", "")
         if p_chatid and msg:
-            await private_message_user(p_chatid, f"[ADMIN]: {msg}", context)
-            await query.edit_message_text("Private message sent to participant.")
+            job_key = await private_message_user(p_chatid, f"[ADMIN]: {msg}", context)
+            if job_key:
+                await query.edit_message_text("Private message queued; it will be delivered shortly.")
+                context.application.create_task(
+                    report_delivery(context.bot, job_key, query.message,
+                                    "Private message sent to participant.",
+                                    "Private message could not be delivered."),
+                    update=None
+                )
+            else:
+                await query.edit_message_text("Private message could not be delivered.")
         else:
             await query.edit_message_text("No message or participant found. Nothing sent.")
         # Clear user_data after sending
@@ -1033,94 +3537,281 @@ async def admin_private_confirm_callback(update: Update, context: ContextTypes.D
         context.user_data["adm_private_chatid"] = None
         context.user_data["adm_private_text"] = ""
 
-async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = str(update.effective_chat.id)
-    text = update.message.text.strip()
-    user_data = context.user_data
-
-    # Participant changing their code from /start
-    if user_data.get("change_code_from_start"):
-        new_code = text
-        update_user_code(chat_id, new_code)
-        await update.message.reply_text(f"Your code has been updated to: {new_code}")
-        user_data.pop("change_code_from_start")
-        return
+# Free-text steps. Each receives the message text and the data stored with its state.
 
-    # Admin sending a broadcast
-    if user_data.get("adm_broadcast"):
-        context.user_data["adm_broadcast_text"] = text
-        keyboard = [
-            [InlineKeyboardButton("Yes", callback_data="adm_broadcast_confirm_yes"),
-            InlineKeyboardButton("No", callback_data="adm_broadcast_confirm_no")]
-        ]
-        markup = InlineKeyboardMarkup(keyboard)
+async def text_change_code(update: Update, context: ContextTypes.DEFAULT_TYPE, text, data):
+    """Participant changing their code from /start."""
+    chat_id = str(update.effective_chat.id)
+    if await update_user_code_async(chat_id, text):
+        await update.message.reply_text(f"Your code has been updated to: {text}")
+    else:
         await update.message.reply_text(
-            f"Confirm broadcast message:\n{text}",
-            reply_markup=markup
+            f"The code {text} is already taken. Use /start to pick a different one."
         )
-        user_data.pop("adm_broadcast")
-        return
 
-    # Admin sending a private message
-    if user_data.get("adm_private_msg"):
-        context.user_data["adm_private_text"] = text
-        p_chatid = user_data.get("adm_private_chatid")
-        if not p_chatid:
-            await update.message.reply_text("Error: No user selected.")
-            return
-        keyboard = [
-            [InlineKeyboardButton("Yes", callback_data="adm_private_confirm_yes"),
-            InlineKeyboardButton("No", callback_data="adm_private_confirm_no")]
-        ]
-        markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(
-            f"Send this message to user?\n{text}",
-            reply_markup=markup
-        )
-        user_data.pop("adm_private_msg")
-        return
+async def text_adm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, text, data):
+    """Admin typed a broadcast; ask for confirmation."""
+    context.user_data["adm_broadcast_text"] = text
+    keyboard = [
+        [InlineKeyboardButton("Yes", callback_data="adm_broadcast_confirm_yes"),
+        InlineKeyboardButton("No", callback_data="adm_broadcast_confirm_no")]
+    ]
+    markup = InlineKeyboardMarkup(keyboard)
+    await update.message.reply_text(
+        f"Confirm broadcast message:\n{text}",
+        reply_markup=markup
+    )
 
-    # Participant sending a message to admin
-    if user_data.get("p2a_typed_message"):
-        user_code = user_data.get("p2a_user_code", "UNKNOWN")
-        context.user_data["p2a_msg_text"] = text
-        keyboard = [
-            [InlineKeyboardButton("Yes", callback_data="p2a_confirm_yes"),
-            InlineKeyboardButton("No", callback_data="p2a_confirm_no")]
-        ]
-        markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(
-            f"Send this message to admin?\n{text}",
-            reply_markup=markup
-        )
-        user_data.pop("p2a_typed_message")
-        return
+async def text_adm_private(update: Update, context: ContextTypes.DEFAULT_TYPE, text, data):
+    """Admin typed a private message for the participant picked earlier."""
+    context.user_data["adm_private_chatid"] = data["target_chat_id"]
+    context.user_data["adm_private_text"] = text
+    keyboard = [
+        [InlineKeyboardButton("Yes", callback_data="adm_private_confirm_yes"),
+        InlineKeyboardButton("No", callback_data="adm_private_confirm_no")]
+    ]
+    markup = InlineKeyboardMarkup(keyboard)
+    await update.message.reply_text(
+        f"Send this message to user?\n{text}",
+        reply_markup=markup
+    )
+
+async def text_p2a_message(update: Update, context: ContextTypes.DEFAULT_TYPE, text, data):
+    """Participant typed a message for the admin."""
+    context.user_data["p2a_user_code"] = data.get("user_code", "UNKNOWN")
+    context.user_data["p2a_msg_text"] = text
+    keyboard = [
+        [InlineKeyboardButton("Yes", callback_data="p2a_confirm_yes"),
+        InlineKeyboardButton("No", callback_data="p2a_confirm_no")]
+    ]
+    markup = InlineKeyboardMarkup(keyboard)
+    await update.message.reply_text(
+        f"Send this message to admin?\n{text}",
+        reply_markup=markup
+    )
+
+async def text_adm_code_search(update: Update, context: ContextTypes.DEFAULT_TYPE, text, data):
+    """Admin searching the codename picker by prefix."""
+    search = text[:64]
+    remember_code_search(context.user_data, search)  # for the result pages' Prev/Next buttons
+    picker_text, markup = await build_code_picker(data["action"], search)
+    await update.message.reply_text(picker_text, reply_markup=markup)
+
+async def text_adm_change_code(update: Update, context: ContextTypes.DEFAULT_TYPE, text, data):
+    """Admin typed a new code for the participant picked earlier."""
+    if await update_user_code_async(data["target_chat_id"], text):
+        await update.message.reply_text(f"Code updated to {text}")
+    else:
+        await update.message.reply_text(f"Code {text} is already in use. Nothing changed.")
+
+TEXT_STATE_HANDLERS = {
+    "change_code": text_change_code,
+    "adm_broadcast": text_adm_broadcast,
+    "adm_private": text_adm_private,
+    "p2a_message": text_p2a_message,
+    "adm_code_search": text_adm_code_search,
+    "adm_change_code": text_adm_change_code,
+}
 
-    # Admin changing a user's code
-    if user_data.get("adm_changing_code"):
-        new_code = text
-        chat_id_to_update = user_data.get("adm_change_user")
-        if chat_id_to_update:
-            update_user_code(chat_id_to_update, new_code)
-            await update.message.reply_text(f"Code updated to {new_code}")
-        user_data.pop("adm_changing_code")
-        user_data.pop("adm_change_user")
+async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    # Every prompt expects exactly one reply, so the state is consumed here.
+    state, data = chat_states.pop(update.effective_chat.id)
+    handler = TEXT_STATE_HANDLERS.get(state)
+    if handler is None:
+        await update.message.reply_text("I didn't understand that. Use /start to begin.")
         return
+    await handler(update, context, text, data)
 
-    # Fallback for unhandled text
-    await update.message.reply_text("I didn't understand that. Use /start to begin.")
+#############################
+# Callback Routing
+#############################
+
+class CallbackRouter:
+    """Dispatches callback_data to exactly one handler, replacing the chain of regex handlers.
+
+    Keys are either exact values ("done_entry") or prefixes ending in "_" or ":"
+    ("adm_find_", "adm_export:"). Exact keys are a single dict lookup. All prefixes
+    are compiled into one longest-first alternation, so a single match finds the
+    most specific prefix ("adm_reset_X" reaches its own handler, not the "adm_"
+    fallback) and a dict lookup maps it to its handler. Compact payloads (see
+    encode_callback) are decoded to the prefix they stand for plus a participant id.
+
+    Handlers read the match from context.callback_prefix and context.callback_arg
+    (the codename for per-participant buttons, old or compact). For compact
+    payloads context.callback_user is the Participant the button was made for;
+    codes need not be unique, so handlers act on it rather than look the code up.
+    It is None for old code-carrying buttons.
+    """
+
+    SEPARATORS = "_:"
+
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = {}
+        self._prefix_re = None
+
+    def add(self, handler, *keys):
+        for key in keys:
+            target = self.prefixes if key[-1] in self.SEPARATORS else self.exact
+            if key in target:
+                raise ValueError(f"Callback key {key!r} registered twice")
+            target[key] = handler
+        self._prefix_re = None
+
+    def compile(self):
+        keys = sorted(self.prefixes, key=len, reverse=True)
+        self._prefix_re = re.compile("|".join(re.escape(k) for k in keys)) if keys else re.compile("(?!)")
+
+    def resolve(self, data):
+        """Return (handler, prefix, argument) for `data`, or None.
+
+        The argument is the text after the prefix, or an int participant id for compact payloads.
+        """
+        handler = self.exact.get(data)
+        if handler is not None:
+            return handler, data, ""
+        if data[:1] == CALLBACK_VERSION:
+            decoded = decode_callback(data)
+            if decoded is not None and decoded[0] in self.prefixes:
+                return self.prefixes[decoded[0]], decoded[0], decoded[1]
+        if self._prefix_re is None:
+            self.compile()
+        m = self._prefix_re.match(data)
+        if m is None:
+            return None
+        return self.prefixes[m.group()], m.group(), data[m.end():]
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        route = self.resolve(query.data or "")
+        if route is None:
+            logger.warning(f"No callback handler for data={query.data}")
+            await query.answer("This button is no longer supported.")
+            return
+        handler, prefix, argument = route
+        user = None
+        if isinstance(argument, int):
+            user = await load_user_by_id_async(argument)
+            if user is None:
+                await query.answer("This participant no longer exists.")
+                return
+            argument = user.code
+        context.callback_prefix = prefix
+        context.callback_arg = argument
+        context.callback_user = user
+        await handler(update, context)
+
+def build_callback_router():
+    router = CallbackRouter()
+    # Participant
+    router.add(handle_start_buttons, "cont_diary", "restart_diary", "change_code_start")
+    router.add(reminder_button_handler, "morning_", "evening_", "contactadmin_")
+    router.add(code_mismatch_handler, "update_code")
+    router.add(done_button_handler, "done_entry", "done_entry:")
+    router.add(participant_to_admin_confirm_callback, "p2a_confirm_yes", "p2a_confirm_no")
+    # Admin menu
+    router.add(admin_menu_handler, "adm_check_progress", "adm_find_code", "adm_reset_change", "adm_forgot",
+               "adm_broadcast", "adm_private", "adm_testall", "adm_next_reminders", "adm_stats", "adm_export")
+    router.add(admin_broadcast_confirm_callback, "adm_broadcast_confirm_yes", "adm_broadcast_confirm_no")
+    router.add(admin_broadcast_cancel_callback, "adm_bcancel_")
+    router.add(admin_private_confirm_callback, "adm_private_confirm_yes", "adm_private_confirm_no")
+    router.add(admin_export_callback, "adm_export:")
+    router.add(admin_progress_page_callback, "adm_prog:")
+    router.add(admin_code_page_callback, "adm_pg:", "adm_pgsearch:")
+    # "adm_find_BCR25", "adm_resetchange_BCR25", "adm_private_BCR25"; "adm_" answers anything unknown
+    router.add(admin_code_inline_handler, "adm_find_", "adm_resetchange_", "adm_private_", "adm_")
+    # "adm_reset_BCR25" or "adm_change_BCR25"
+    router.add(admin_reset_change_callback, "adm_reset_", "adm_change_")
+    router.compile()
+    return router
 
 #############################
 # Main
 #############################
 
-def main():
-    logger.info("Starting main function. Initializing DB and building application.")
-    init_db()
-    # fix_db()  # if needed
+class ChatOrderedApplication(Application):
+    """Application that processes updates of different chats concurrently, each chat's in order.
+
+    With concurrent_updates set, PTB runs every update as its own task. The
+    registration ConversationHandler, chat_states and the confirm flows in
+    user_data all assume one update at a time per chat, so updates are
+    serialized on a per-chat lock; updates without a chat are not.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._chat_locks = {}  # chat id -> [asyncio.Lock, updates holding or waiting for it]
+
+    async def process_update(self, update):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            return await super().process_update(update)
+        entry = self._chat_locks.get(chat.id)
+        if entry is None:
+            entry = self._chat_locks[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat.id]
+
+def run_worker(application):
+    """Run the outbox dispatcher and (if elected) the scheduler, without polling Telegram."""
+    logger.info(f"Starting delivery worker {WORKER_ID}.")
+
+    async def _serve():
+        await application.initialize()
+        await start_background_services(application)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await stop_background_services(application)
+            await application.shutdown()
 
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    loop = asyncio.get_event_loop()
+    task = loop.create_task(_serve())
+    try:
+        loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        logger.info(f"Worker {WORKER_ID} stopping.")
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+
+def webhook_settings():
+    """Keyword arguments for run_webhook()/start_webhook() from the WEBHOOK_* settings."""
+    # Without a URL, PTB would register one built from listen/port/path (e.g.
+    # http://0.0.0.0:8443/telegram) instead of leaving the webhook alone.
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook needs WEBHOOK_URL, the public base URL Telegram should POST to.")
+    # Registered by run_webhook() along with the URL; the last replica to start wins,
+    # so all of them must use the same secret.
+    secret = WEBHOOK_SECRET or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+    if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", secret):
+        raise RuntimeError("WEBHOOK_SECRET may only contain A-Z, a-z, 0-9, _ and - (1-256 characters).")
+    return {
+        "listen": WEBHOOK_LISTEN,
+        "port": WEBHOOK_PORT,
+        "url_path": WEBHOOK_PATH,
+        "webhook_url": f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+        "secret_token": secret,
+    }
+
+def application_builder(persistence=bot_persistence):
+    """ApplicationBuilder with the bot's update processing settings (also used by benchmarks/)."""
+    return (
+        ApplicationBuilder()
+        .application_class(ChatOrderedApplication)
+        .token(BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .persistence(persistence)
+    )
 
+def add_handlers(application):
+    """Register the bot's update handlers on `application`."""
     # Registration conversation
     reg_conv = ConversationHandler(
         entry_points=[CommandHandler("start", start_registration)],
@@ -1131,54 +3822,56 @@ def main():
             REG_AGE:    [MessageHandler(filters.TEXT & ~filters.COMMAND, reg_age)],
         },
         fallbacks=[CommandHandler("cancel", reg_cancel)],
+        name="registration",
+        persistent=True,
     )
     application.add_handler(reg_conv)
 
-    # Start/restart/change code
-    application.add_handler(CallbackQueryHandler(handle_start_buttons,
-        pattern="^(cont_diary|restart_diary|change_code_start)$"))
+    # Every inline button goes through one router
+    application.add_handler(CallbackQueryHandler(build_callback_router().dispatch))
 
-    # Schedule the reminder jobs
-    schedule_jobs(application)
-
-    # Reminders
-    application.add_handler(CallbackQueryHandler(reminder_button_handler,
-        pattern="^(morning_|evening_|contactadmin_)"))
-    application.add_handler(CallbackQueryHandler(code_mismatch_handler,
-        pattern="^(update_code|restart_diary)$"))
-    application.add_handler(CallbackQueryHandler(done_button_handler,
-        pattern="^done_entry$"))
-
-    # Participant->Admin confirm typed message
-    application.add_handler(CallbackQueryHandler(participant_to_admin_confirm_callback,
-        pattern="^(p2a_confirm_yes|p2a_confirm_no)$"))
+    # Per-participant reminder settings
+    application.add_handler(CommandHandler("timezone", timezone_command))
+    application.add_handler(CommandHandler("remindertime", remindertime_command))
 
     # Admin
     application.add_handler(CommandHandler("admin", admin_command))
-    application.add_handler(CallbackQueryHandler(admin_menu_handler,
-        pattern="^(adm_check_progress|adm_find_code|adm_reset_change|adm_forgot|adm_broadcast|adm_private|adm_testall|adm_next_reminders)$"))
-
-    # "adm_find_BCR25", "adm_reset_change_BCR25", "adm_private_BCR25"
-    application.add_handler(CallbackQueryHandler(admin_code_inline_handler,
-        pattern="^adm_"))
 
-    # "adm_reset_BCR25" or "adm_change_BCR25"
-    application.add_handler(CallbackQueryHandler(admin_reset_change_callback,
-        pattern="^(adm_reset_|adm_change_)"))
+    # Single text handler
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
 
-    # Confirm broadcast
-    application.add_handler(CallbackQueryHandler(admin_broadcast_confirm_callback,
-        pattern="^(adm_broadcast_confirm_yes|adm_broadcast_confirm_no)$"))
+def main():
+    logger.info("Starting main function. Initializing DB and building application.")
+    init_db()
+    # fix_db()  # if needed
 
-    # Confirm private message
-    application.add_handler(CallbackQueryHandler(admin_private_confirm_callback,
-        pattern="^(adm_private_confirm_yes|adm_private_confirm_no)$"))
+    application = (
+        application_builder()
+        .post_init(start_background_services)
+        .post_shutdown(stop_background_services)
+        .build()
+    )
+    add_handlers(application)
 
-    # Single text handler
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
+    # Schedule the reminder jobs
+    schedule_jobs(application)
 
-    logger.info("Starting the bot with run_polling(). Make sure only one instance is running.")
-    application.run_polling()
+    try:
+        if BOT_ROLE == "worker":
+            run_worker(application)
+        elif BOT_MODE == "webhook":
+            settings = webhook_settings()
+            logger.info(f"Starting the bot with run_webhook() on {settings['listen']}:{settings['port']}"
+                        f"/{settings['url_path']} (registering {settings['webhook_url']}).")
+            application.run_webhook(**settings)
+        else:
+            logger.info("Starting the bot with run_polling(). Only one instance may poll; "
+                        "start extra delivery workers with BOT_ROLE=worker.")
+            application.run_polling()
+    finally:
+        _db_executor.shutdown(wait=True)
+        if db_pool is not None:
+            db_pool.closeall()
 
 if __name__ == "__main__":
     main()
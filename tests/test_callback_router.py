@@ -0,0 +1,155 @@
+"""Every callback_data the bot emits reaches the handler it is meant for.
+
+Handlers are replaced by recorders before build_callback_router() runs, so the
+tests exercise CallbackRouter.dispatch end to end without Telegram or a database.
+
+Run from the repository root:  python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import newone  # noqa: E402
+
+# callback_data -> (handler, context.callback_prefix, context.callback_arg)
+ROUTES = {
+    # Participant
+    "cont_diary": ("handle_start_buttons", "cont_diary", ""),
+    "restart_diary": ("handle_start_buttons", "restart_diary", ""),
+    "change_code_start": ("handle_start_buttons", "change_code_start", ""),
+    "morning_BCR25": ("reminder_button_handler", "morning_", "BCR25"),
+    "evening_BCR25-2": ("reminder_button_handler", "evening_", "BCR25-2"),
+    "morning_TEST": ("reminder_button_handler", "morning_", "TEST"),
+    "contactadmin_BCR25": ("reminder_button_handler", "contactadmin_", "BCR25"),
+    "update_code": ("code_mismatch_handler", "update_code", ""),
+    "done_entry": ("done_button_handler", "done_entry", ""),
+    "done_entry:morning": ("done_button_handler", "done_entry:", "morning"),
+    "done_entry:evening": ("done_button_handler", "done_entry:", "evening"),
+    "p2a_confirm_yes": ("participant_to_admin_confirm_callback", "p2a_confirm_yes", ""),
+    "p2a_confirm_no": ("participant_to_admin_confirm_callback", "p2a_confirm_no", ""),
+    # Admin menu
+    "adm_check_progress": ("admin_menu_handler", "adm_check_progress", ""),
+    "adm_find_code": ("admin_menu_handler", "adm_find_code", ""),
+    "adm_reset_change": ("admin_menu_handler", "adm_reset_change", ""),
+    "adm_forgot": ("admin_menu_handler", "adm_forgot", ""),
+    "adm_broadcast": ("admin_menu_handler", "adm_broadcast", ""),
+    "adm_private": ("admin_menu_handler", "adm_private", ""),
+    "adm_testall": ("admin_menu_handler", "adm_testall", ""),
+    "adm_next_reminders": ("admin_menu_handler", "adm_next_reminders", ""),
+    "adm_stats": ("admin_menu_handler", "adm_stats", ""),
+    "adm_export": ("admin_menu_handler", "adm_export", ""),
+    "adm_broadcast_confirm_yes": ("admin_broadcast_confirm_callback", "adm_broadcast_confirm_yes", ""),
+    "adm_broadcast_confirm_no": ("admin_broadcast_confirm_callback", "adm_broadcast_confirm_no", ""),
+    "adm_bcancel_0123456789ab": ("admin_broadcast_cancel_callback", "adm_bcancel_", "0123456789ab"),
+    "adm_private_confirm_yes": ("admin_private_confirm_callback", "adm_private_confirm_yes", ""),
+    "adm_private_confirm_no": ("admin_private_confirm_callback", "adm_private_confirm_no", ""),
+    "adm_export:participants:csv": ("admin_export_callback", "adm_export:", "participants:csv"),
+    "adm_prog:n:": ("admin_progress_page_callback", "adm_prog:", "n:"),
+    "adm_prog:p:2bq": ("admin_progress_page_callback", "adm_prog:", "p:2bq"),
+    "adm_pg:find:n:a:": ("admin_code_page_callback", "adm_pg:", "find:n:a:"),
+    "adm_pg:private:p:s1x9kd3:2bq": ("admin_code_page_callback", "adm_pg:", "private:p:s1x9kd3:2bq"),
+    "adm_pgsearch:resetchange": ("admin_code_page_callback", "adm_pgsearch:", "resetchange"),
+    # Old code-carrying per-participant buttons; the most specific prefix wins
+    "adm_find_BCR25": ("admin_code_inline_handler", "adm_find_", "BCR25"),
+    "adm_find_A_B": ("admin_code_inline_handler", "adm_find_", "A_B"),
+    "adm_resetchange_BCR25": ("admin_code_inline_handler", "adm_resetchange_", "BCR25"),
+    "adm_private_BCR25": ("admin_code_inline_handler", "adm_private_", "BCR25"),
+    "adm_reset_BCR25": ("admin_reset_change_callback", "adm_reset_", "BCR25"),
+    "adm_change_BCR25": ("admin_reset_change_callback", "adm_change_", "BCR25"),
+    "adm_unknown_thing": ("admin_code_inline_handler", "adm_", "unknown_thing"),
+}
+
+# Compact opcode -> handler its payloads reach
+OPCODE_HANDLERS = {
+    "m": "reminder_button_handler",
+    "e": "reminder_button_handler",
+    "c": "reminder_button_handler",
+    "f": "admin_code_inline_handler",
+    "r": "admin_code_inline_handler",
+    "p": "admin_code_inline_handler",
+    "x": "admin_reset_change_callback",
+    "y": "admin_reset_change_callback",
+}
+
+PARTICIPANT = newone.Participant(chat_id="1001", code="BCR25", id=int("2bq", 36))
+
+class FakeQuery:
+    def __init__(self, data):
+        self.data = data
+        self.answers = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+@pytest.fixture
+def router(monkeypatch):
+    """build_callback_router() with every handler replaced by a recorder; calls land in router.calls."""
+    calls = []
+
+    def recorder(name):
+        async def handler(update, context):
+            calls.append((name, context.callback_prefix, context.callback_arg, context.callback_user))
+        handler.__name__ = name
+        return handler
+
+    names = {name for name, _, _ in ROUTES.values()} | set(OPCODE_HANDLERS.values())
+    for name in names:
+        monkeypatch.setattr(newone, name, recorder(name))
+
+    async def load_user_by_id(participant_id):
+        return PARTICIPANT if participant_id == PARTICIPANT.id else None
+
+    monkeypatch.setattr(newone, "load_user_by_id_async", load_user_by_id)
+    router = newone.build_callback_router()
+    router.calls = calls
+    return router
+
+def dispatch(router, data):
+    query = FakeQuery(data)
+    context = SimpleNamespace()
+    asyncio.run(router.dispatch(SimpleNamespace(callback_query=query), context))
+    return query
+
+@pytest.mark.parametrize("data", sorted(ROUTES))
+def test_callback_reaches_its_handler(router, data):
+    query = dispatch(router, data)
+    assert router.calls == [ROUTES[data] + (None,)]
+    assert query.answers == []
+
+@pytest.mark.parametrize("opcode", sorted(OPCODE_HANDLERS))
+def test_compact_payload_reaches_its_handler(router, opcode):
+    prefix = newone.CALLBACK_OPCODES[opcode]
+    data = newone.encode_callback(prefix, PARTICIPANT.id)
+    assert data == f"{newone.CALLBACK_VERSION}{opcode}2bq"
+    dispatch(router, data)
+    assert router.calls == [(OPCODE_HANDLERS[opcode], prefix, PARTICIPANT.code, PARTICIPANT)]
+
+def test_every_opcode_is_routed():
+    assert set(OPCODE_HANDLERS) == set(newone.CALLBACK_OPCODES)
+
+def test_every_registered_key_is_covered(router):
+    registered = set(router.exact) | set(router.prefixes)
+    covered = {prefix for _, prefix, _ in ROUTES.values()}
+    assert registered == covered
+
+@pytest.mark.parametrize("data", ["nonsense", "", "done_entr", "2m2bq"])
+def test_unknown_payload_is_answered_without_a_handler(router, data):
+    query = dispatch(router, data)
+    assert router.calls == []
+    assert query.answers == ["This button is no longer supported."]
+
+def test_compact_payload_for_a_deleted_participant(router):
+    query = dispatch(router, newone.encode_callback("morning_", PARTICIPANT.id + 1))
+    assert router.calls == []
+    assert query.answers == ["This participant no longer exists."]
+
+def test_malformed_compact_payload_falls_back_to_prefixes(router):
+    # "1m" followed by a non-base-36 id is not a compact payload and matches no prefix
+    query = dispatch(router, "1m!!")
+    assert router.calls == []
+    assert query.answers == ["This button is no longer supported."]